@@ -0,0 +1,69 @@
+import asyncio
+import threading
+from datetime import date
+from functools import cache
+from typing import TYPE_CHECKING, Any, Coroutine
+
+import pandas as pd
+
+from utils import format_rollup_df
+
+if TYPE_CHECKING:
+    from supabase import AsyncClient
+
+
+class AsyncSupabaseClient:
+    """Async counterpart of SupabaseClient's reads, used to fetch page data
+    concurrently.
+
+    Streamlit runs each script in its own thread without an event loop, so
+    the async client lives on a private loop thread and callers block on
+    `run`/`gather`. Keeping one loop lets the HTTP connections be reused
+    across reruns."""
+
+    def __init__(self, url: str, key: str) -> None:
+        from supabase import acreate_client
+
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(
+            target=self.loop.run_forever, name="supabase-async", daemon=True
+        ).start()
+        self.client: "AsyncClient" = self.run(acreate_client(url, key))
+
+    def run(self, coroutine: Coroutine) -> Any:
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def gather(self, *coroutines: Coroutine) -> list:
+        async def _gather():
+            return await asyncio.gather(*coroutines)
+
+        return self.run(_gather())
+
+    async def load_categories(self, user_id: int | None = None) -> pd.DataFrame:
+        query = self.client.table("categories").select("id,name")
+        if user_id is not None:
+            query = query.or_(f"user_id.is.null,user_id.eq.{user_id}")
+        response = await query.execute()
+        return pd.DataFrame(response.data, columns=["id", "name"])
+
+    async def load_monthly_totals(
+        self,
+        start_date: date | None = None,
+        end_date: date | None = None,
+        user_id: int | None = None,
+    ) -> pd.DataFrame:
+        response = await self.client.rpc(
+            "get_monthly_totals",
+            {
+                "start_date": start_date.isoformat() if start_date else None,
+                "end_date": end_date.isoformat() if end_date else None,
+                "for_user": user_id,
+            },
+        ).execute()
+        return format_rollup_df(pd.DataFrame(response.data))
+
+
+@cache
+def get_async_client(url: str, key: str) -> AsyncSupabaseClient:
+    """One loop thread and connection pool per project, shared by accounts"""
+    return AsyncSupabaseClient(url, key)
@@ -1,17 +1,31 @@
-import hashlib
-import hmac
+import logging
 import os
+import secrets
+import threading
 import time
 from datetime import datetime, timedelta
+from functools import cached_property
 
 import jwt
 import streamlit as st
 from dotenv import load_dotenv
 
+from metrics import timed
+from passwords import check_password, hash_password
+
 load_dotenv()
 
+# Verified tokens remembered at once, expired ones are dropped first
+MAX_VERIFIED_TOKENS = 1024
+
+logger = logging.getLogger(__name__)
+
 
 class Authenticator:
+    """Logs in the admin configured in the environment, or any account stored
+    in the users table. Tokens carry the account's username, user_id and
+    admin flag."""
+
     def __init__(self):
         self.correct_username = os.environ.get("ADMIN_USERNAME")
         self.correct_password_hash = os.environ.get("ADMIN_PASSWORD_HASH")
@@ -22,38 +36,101 @@ class Authenticator:
             [self.correct_username, self.correct_password_hash, self.jwt_secret]
         ):
             raise ValueError("Authentication credentials not properly configured")
+        if not self.correct_password_hash.startswith("pbkdf2_sha256:"):
+            logger.warning(
+                "ADMIN_PASSWORD_HASH is an unsalted SHA-256 digest, "
+                "regenerate it with `python src/utils.py`"
+            )
 
-        # Initialize session state
-        if "token" not in st.session_state:
-            st.session_state.token = None
+        # Claims of each token that passed verification, so reruns skip jwt.decode
+        self._verified: dict[str, dict] = {}
+        self._verified_lock = threading.Lock()
 
     def hash_password(self, password: str) -> str:
-        """Create a hash of the password using SHA-256"""
-        return hashlib.sha256(password.encode()).hexdigest()
+        """Create a salted PBKDF2 hash of the password"""
+        return hash_password(password)
 
     def verify_password(self, provided_password: str) -> bool:
         """Verify the provided password against stored hash"""
-        provided_hash = self.hash_password(provided_password)
-        return hmac.compare_digest(provided_hash, self.correct_password_hash)
+        return check_password(provided_password, self.correct_password_hash)
+
+    @property
+    def accounts(self):
+        # Imported on the first login attempt rather than with this module,
+        # so the login form renders before the storage layer is loaded
+        from supabase_client import supabase_client
+
+        return supabase_client
+
+    @cached_property
+    def _dummy_hash(self) -> str:
+        return hash_password(secrets.token_hex())
 
-    def create_token(self) -> str:
+    def authenticate(self, username: str, password: str) -> dict | None:
+        """Claims for the account the credentials belong to, if they are valid"""
+        if username == self.correct_username:
+            if not self.verify_password(password):
+                return None
+            user_id = self.accounts.ensure_admin(username, self.correct_password_hash)
+            return {"username": username, "user_id": user_id, "admin": True}
+        user = self.accounts.load_user(username)
+        # Check unknown usernames too so timing doesn't reveal which exist
+        password_ok = check_password(
+            password, user["password_hash"] if user else self._dummy_hash
+        )
+        if user is None or not password_ok:
+            return None
+        return {
+            "username": user["username"],
+            "user_id": int(user["id"]),
+            "admin": bool(user["is_admin"]),
+        }
+
+    def create_token(self, user: dict) -> str:
         """Create a JWT token"""
         expiry = datetime.utcnow() + timedelta(days=self.jwt_expiry_days)
         return jwt.encode(
-            {"username": self.correct_username, "exp": expiry},
+            {**user, "exp": expiry},
             self.jwt_secret,
             algorithm="HS256",
         )
 
-    def verify_token(self, token: str) -> bool:
-        """Verify the JWT token"""
+    def verify_token(self, token: str) -> dict | None:
+        """Return the claims of a valid JWT token, decoding it only the first
+        time it is seen"""
+        with self._verified_lock:
+            claims = self._verified.get(token)
+        if claims is not None:
+            if time.time() < claims["exp"]:
+                return claims
+            self.forget_token(token)
+            return None
         try:
-            payload = jwt.decode(token, self.jwt_secret, algorithms=["HS256"])
-            return payload["username"] == self.correct_username
+            claims = jwt.decode(token, self.jwt_secret, algorithms=["HS256"])
         except jwt.ExpiredSignatureError:
-            return False
+            return None
         except jwt.InvalidTokenError:
-            return False
+            return None
+        if "user_id" not in claims:
+            # Issued before accounts existed
+            return None
+        self._remember_token(token, claims)
+        return claims
+
+    def _remember_token(self, token: str, claims: dict) -> None:
+        with self._verified_lock:
+            if len(self._verified) >= MAX_VERIFIED_TOKENS:
+                now = time.time()
+                self._verified = {
+                    t: c for t, c in self._verified.items() if c["exp"] > now
+                }
+            if len(self._verified) >= MAX_VERIFIED_TOKENS:
+                del self._verified[next(iter(self._verified))]
+            self._verified[token] = claims
+
+    def forget_token(self, token: str) -> None:
+        with self._verified_lock:
+            self._verified.pop(token, None)
 
     def login(self) -> bool:
         """Handle the login process"""
@@ -120,8 +197,9 @@ class Authenticator:
             remember_me = st.checkbox("Keep me logged in", value=True)
 
             if st.button("Login"):
-                if username == self.correct_username and self.verify_password(password):
-                    token = self.create_token()
+                user = self.authenticate(username, password)
+                if user is not None:
+                    token = self.create_token(user)
                     st.session_state.token = token
                     if remember_me:
                         st.markdown(
@@ -148,15 +226,23 @@ class Authenticator:
 
         return False
 
-    def check_authentication(self):
-        """Main authentication check"""
-        if not st.session_state.token or not self.verify_token(st.session_state.token):
+    @timed("auth.check_authentication")
+    def check_authentication(self) -> dict:
+        """Main authentication check, returns the logged in account's claims"""
+        if "token" not in st.session_state:
+            st.session_state.token = None
+        user = st.session_state.token and self.verify_token(st.session_state.token)
+        if not user:
             if not self.login():
                 st.stop()
+            user = self.verify_token(st.session_state.token)
+        return user
 
     def logout(self):
         """Handle logout"""
         if st.button("Logout"):
+            if st.session_state.token:
+                self.forget_token(st.session_state.token)
             st.session_state.token = None
             # Clear token from local storage
             st.markdown(
@@ -168,3 +254,6 @@ class Authenticator:
                 unsafe_allow_html=True,
             )
             st.rerun()
+
+
+authenticator = Authenticator()
@@ -0,0 +1,514 @@
+"""Benchmarks for the data path against an in-memory stand-in for Supabase.
+
+    python src/benchmark.py --sizes 1000 10000 100000 1000000
+    python src/benchmark.py --save-baseline
+    python src/benchmark.py --compare
+    python src/benchmark.py --imports
+
+Each benchmark reports wall time, peak traced memory and the number of
+requests that would have been sent to Supabase. --imports instead times
+cold starts, each in a fresh interpreter.
+"""
+
+import argparse
+import io
+import json
+import os
+import subprocess
+import sys
+import time
+import tracemalloc
+from datetime import date
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Callable
+
+import numpy as np
+import pandas as pd
+
+from export import export_entries, temporary_export_path
+from supabase_client import SupabaseClient
+from ui import calculate_stats
+
+SRC_PATH = Path(__file__).parent
+BASELINE_PATH = SRC_PATH.parent / "benchmarks" / "baseline.json"
+DEFAULT_SIZES = [1_000, 10_000, 100_000]
+# Absolute slack so millisecond-scale jitter is not reported as a regression
+SLACK = {"time": 0.02, "peak_mb": 1.0}
+CATEGORIES = [
+    "Groceries", "Rent", "Restaurants", "Transport", "Utilities", "Health",
+    "Shopping", "Entertainment", "Travel", "Gifts", "Education", "Insurance",
+    "Salary", "Investments", "Other",
+]  # fmt: skip
+
+
+def generate_ledger(size: int, seed: int = 0) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """Synthetic categories and expenses tables with Zipf-like category skew"""
+    rng = np.random.default_rng(seed)
+    categories = pd.DataFrame(
+        {"id": np.arange(1, len(CATEGORIES) + 1), "name": CATEGORIES}
+    )
+    weights = 1 / np.arange(1, len(CATEGORIES) + 1) ** 1.2
+    days = pd.date_range("2015-01-01", date.today()).strftime("%Y-%m-%d").to_numpy()
+    dates = days[rng.integers(0, len(days), size)]
+    expenses = pd.DataFrame(
+        {
+            "id": np.arange(1, size + 1),
+            "type": rng.choice(["Expense", "Income"], size, p=[0.9, 0.1]),
+            "title": rng.choice([f"Merchant {i}" for i in range(2_000)], size),
+            "category": rng.choice(categories["id"], size, p=weights / weights.sum()),
+            "amount": rng.lognormal(3, 1, size).round(2),
+            "date": dates,
+            "updated_at": pd.Series(dates) + "T12:00:00+00:00",
+        }
+    )
+    return categories, expenses
+
+
+def ledger_to_csv(categories: pd.DataFrame, expenses: pd.DataFrame) -> bytes:
+    names = dict(zip(categories["id"], categories["name"]))
+    export = expenses.assign(
+        category=expenses["category"].map(names),
+        date=expenses["date"].str.replace("-", "/"),
+    )[["type", "title", "category", "amount", "date"]]
+    return export.to_csv(index=False).encode()
+
+
+class InMemoryClient:
+    """Just enough of the supabase/postgrest client API for SupabaseClient"""
+
+    def __init__(self, categories: pd.DataFrame, expenses: pd.DataFrame) -> None:
+        self.tables = {
+            "categories": categories.copy(),
+            "expenses": expenses.copy(),
+            "expenses_tombstones": pd.DataFrame(columns=["id", "deleted_at"]),
+        }
+        # The unique index on expenses.idempotency_key
+        self.idempotency_keys: set[str] = set()
+        self.requests = 0
+        self.rows_transferred = 0
+        self.postgrest = self
+
+    def table(self, name: str) -> "InMemoryQuery":
+        return InMemoryQuery(self, name)
+
+    def rpc(self, name: str, params: dict | None = None, count=None, **_):
+        return InMemoryQuery(self, name, params or {}, count)
+
+    def expenses_with_categories(self) -> pd.DataFrame:
+        categories = self.tables["categories"].rename(
+            columns={"id": "category", "name": "category_name"}
+        )
+        return (
+            self.tables["expenses"]
+            .merge(categories, on="category", how="left")
+            .drop(columns="category")
+            .rename(columns={"category_name": "category"})
+        )
+
+    def in_range(self, frame: pd.DataFrame, params: dict) -> pd.DataFrame:
+        if params.get("start_date"):
+            frame = frame[frame["date"] >= params["start_date"]]
+        if params.get("end_date"):
+            frame = frame[frame["date"] <= params["end_date"]]
+        return frame
+
+    def run_rpc(self, name: str, params: dict) -> pd.DataFrame:
+        if name == "get_expenses_with_categories":
+            return self.expenses_with_categories()
+        entries = self.in_range(self.expenses_with_categories(), params)
+        month = entries["date"].str[:7] + "-01"
+        if name == "get_monthly_totals":
+            return (
+                entries.groupby([month.rename("month"), "type", "category"])["amount"]
+                .sum()
+                .reset_index()
+            )
+        if name == "get_category_totals":
+            entries = entries[entries["type"] == params.get("entry_type", "Expense")]
+            return (
+                entries.groupby("category")["amount"]
+                .sum()
+                .sort_values(ascending=False)
+                .reset_index()
+            )
+        if name == "get_daily_totals":
+            entries = entries[entries["type"] == params.get("entry_type", "Expense")]
+            return entries.groupby(["date", "category"])["amount"].sum().reset_index()
+        if name == "get_savings_series":
+            totals = entries.pivot_table(
+                index=month.rename("month"),
+                columns="type",
+                values="amount",
+                aggfunc="sum",
+                fill_value=0,
+            ).reindex(columns=["Income", "Expense"], fill_value=0)
+            return pd.DataFrame(
+                {
+                    "income": totals["Income"],
+                    "expenses": totals["Expense"],
+                    "savings": totals["Income"] - totals["Expense"],
+                }
+            ).reset_index()
+        raise ValueError(f"Unknown RPC {name}")
+
+
+class InMemoryQuery:
+    def __init__(self, db: InMemoryClient, source: str, params=None, count=None):
+        self.db = db
+        self.source = source
+        self.params = params
+        self.count = count
+        self.action = "select"
+        self.payload = None
+        self.on_conflict = None
+        self.columns = None
+        self.filters = []
+        self.orders = []
+        self.bounds = None
+
+    def select(self, *columns: str, count=None, **_):
+        self.columns = ",".join(columns).split(",") if columns != ("*",) else None
+        self.count = count
+        return self
+
+    def insert(self, rows, **_):
+        self.action, self.payload = "insert", rows
+        return self
+
+    def upsert(self, rows, on_conflict=None, **_):
+        self.action, self.payload = "upsert", rows
+        self.on_conflict = on_conflict
+        return self
+
+    def update(self, values, **_):
+        self.action, self.payload = "update", values
+        return self
+
+    def delete(self, **_):
+        self.action = "delete"
+        return self
+
+    def _filter(self, column, op, value):
+        self.filters.append((column, op, value))
+        return self
+
+    def eq(self, column, value):
+        return self._filter(column, "eq", value)
+
+    def gt(self, column, value):
+        return self._filter(column, "gt", value)
+
+    def gte(self, column, value):
+        return self._filter(column, "gte", value)
+
+    def lte(self, column, value):
+        return self._filter(column, "lte", value)
+
+    def in_(self, column, values):
+        return self._filter(column, "in", list(values))
+
+    def order(self, column, desc=False, **_):
+        self.orders.append((column, not desc))
+        return self
+
+    def or_(self, filters: str, **_):
+        # Only the keyset condition of iter_entries,
+        # "date.gt.<date>,and(date.eq.<date>,id.gt.<id>)"
+        after, tie = filters.split(",and(")
+        last_id = tie.rstrip(")").split(",")[1].split(".", 2)[2]
+        return self._filter(None, "after", (after.split(".", 2)[2], int(last_id)))
+
+    def range(self, start, end, **_):
+        self.bounds = (start, end)
+        return self
+
+    def limit(self, size, **_):
+        return self.range(0, size - 1)
+
+    def _mask(self, frame: pd.DataFrame) -> pd.Series:
+        mask = pd.Series(True, index=frame.index)
+        for column, op, value in self.filters:
+            if op == "after":
+                last_date, last_id = value
+                mask &= (frame["date"] > last_date) | (
+                    (frame["date"] == last_date) & (frame["id"] > last_id)
+                )
+                continue
+            values = frame[column]
+            if op == "in":
+                mask &= values.isin(value)
+            else:
+                mask &= getattr(values, {"gte": "ge", "lte": "le"}.get(op, op))(value)
+        return mask
+
+    def execute(self):
+        self.db.requests += 1
+        if self.source in self.db.tables:
+            frame = self._write()
+        else:
+            frame = self.db.run_rpc(self.source, self.params)
+            frame = frame[self._mask(frame)]
+        total = len(frame)
+        if self.orders:
+            frame = frame.sort_values(
+                [column for column, _ in self.orders],
+                ascending=[ascending for _, ascending in self.orders],
+            )
+        if self.bounds:
+            frame = frame.iloc[self.bounds[0] : self.bounds[1] + 1]
+        if self.columns:
+            frame = frame[self.columns]
+        self.db.rows_transferred += len(frame)
+        return SimpleNamespace(data=frame.to_dict("records"), count=total)
+
+    def _write(self) -> pd.DataFrame:
+        table = self.db.tables[self.source]
+        now = pd.Timestamp.now(tz="UTC").isoformat()
+        if self.action == "select":
+            return table[self._mask(table)]
+        if self.action == "insert" or self.on_conflict not in (None, "id"):
+            rows = pd.DataFrame(
+                self.payload if isinstance(self.payload, list) else [self.payload]
+            )
+            if self.on_conflict not in (None, "idempotency_key"):
+                # Upserts on anything else ignore duplicates, like categories'
+                columns = self.on_conflict.split(",")
+                stored = set(_keys(table, columns))
+                rows = rows[[key not in stored for key in _keys(rows, columns)]]
+            if "idempotency_key" in rows:
+                keys = self.db.idempotency_keys
+                rows = rows[[key not in keys for key in rows["idempotency_key"]]]
+                self.db.idempotency_keys.update(rows["idempotency_key"])
+            next_id = int(table["id"].max()) + 1 if not table.empty else 1
+            rows["id"] = np.arange(next_id, next_id + len(rows))
+            if "updated_at" in table.columns:
+                rows["updated_at"] = now
+            self.db.tables[self.source] = pd.concat([table, rows], ignore_index=True)
+            return rows
+        mask = self._mask(table)
+        if self.action == "delete":
+            self.db.tables[self.source] = table[~mask]
+            tombstones = pd.DataFrame({"id": table.loc[mask, "id"], "deleted_at": now})
+            self.db.tables["expenses_tombstones"] = pd.concat(
+                [self.db.tables["expenses_tombstones"], tombstones], ignore_index=True
+            )
+            return table[mask]
+        if self.action == "update":
+            for column, value in self.payload.items():
+                table.loc[mask, column] = value
+            table.loc[mask, "updated_at"] = now
+            return table[mask]
+        rows = pd.DataFrame(self.payload).assign(updated_at=now).set_index("id")
+        table = table.set_index("id")
+        table.update(rows)
+        self.db.tables[self.source] = table.reset_index()
+        return rows.reset_index()
+
+
+def _keys(frame: pd.DataFrame, columns: list[str]) -> list[tuple]:
+    """Rows' values in `columns`, missing ones as None so that they compare equal"""
+    values = frame.reindex(columns=columns).astype(object)
+    return list(values.where(values.notna(), None).itertuples(index=False, name=None))
+
+
+def measure(
+    setup: Callable[[], object],
+    func: Callable[[], object],
+    db: InMemoryClient,
+    memory: bool,
+) -> dict:
+    setup()
+    requests, rows = db.requests, db.rows_transferred
+    start = time.perf_counter()
+    func()
+    result = {
+        "time": round(time.perf_counter() - start, 4),
+        "requests": db.requests - requests,
+        "rows_transferred": db.rows_transferred - rows,
+    }
+    if memory:
+        setup()
+        tracemalloc.start()
+        func()
+        result["peak_mb"] = round(tracemalloc.get_traced_memory()[1] / 1e6, 2)
+        tracemalloc.stop()
+    return result
+
+
+def run_benchmarks(size: int, memory: bool = True) -> dict[str, dict]:
+    categories, expenses = generate_ledger(size)
+    db = InMemoryClient(categories, expenses)
+    client = SupabaseClient(client=db)
+    csv = ledger_to_csv(categories, expenses)
+    export_path = temporary_export_path("Parquet")
+
+    def cold():
+        db.tables["expenses"] = expenses.copy()
+        db.idempotency_keys.clear()
+        client.cache.invalidate()
+        client._ledger = None
+
+    def empty():
+        cold()
+        db.tables["expenses"] = expenses.iloc[:0].copy()
+
+    def warm():
+        cold()
+        client.load_data()
+
+    def write_then_load():
+        client.save_entry("Expense", "Benchmark", 1, 1.0, "2024-01-01")
+        return client.load_data()
+
+    benchmarks = {
+        "process_csv": (empty, lambda: client.process_csv(io.BytesIO(csv))),
+        # Every row is already stored, only the duplicate check runs
+        "process_csv_repeat": (cold, lambda: client.process_csv(io.BytesIO(csv))),
+        "load_data": (cold, client.load_data),
+        "load_data_delta": (warm, write_then_load),
+        "query_entries": (
+            cold,
+            lambda: client.query_entries(
+                type="Expense",
+                start_date=date(2020, 1, 1),
+                categories=("Groceries", "Restaurants"),
+                order_by="amount",
+                page_size=50,
+            ),
+        ),
+        "calculate_stats": (
+            cold,
+            lambda: calculate_stats(
+                client.load_rollup(), pd.Period(date.today(), freq="M")
+            ),
+        ),
+        "spending_series": (cold, lambda: client.load_spending_series("W")),
+        # Peak memory should stay at about one batch whatever the ledger size
+        "export_parquet": (
+            cold,
+            lambda: [*export_entries(client, export_path, "Parquet")],
+        ),
+    }
+    try:
+        return {
+            name: measure(setup, func, db, memory)
+            for name, (setup, func) in benchmarks.items()
+        }
+    finally:
+        os.remove(export_path)
+
+
+# Modules that dominate a cold start, reported when a stage loaded them
+HEAVY_MODULES = ["pandas", "pyarrow", "plotly.express", "reportlab", "supabase"]
+IMPORT_STAGES = {
+    # What main.py imports before the login form renders
+    "login_imports": "import streamlit, metrics, auth",
+    # Interpreter start to the login form rendered, streamlit.testing included
+    "login_paint": "from streamlit.testing.v1 import AppTest\n"
+    "AppTest.from_file('main.py').run(timeout=60)",
+    # What the first signed-in rerun imports on top
+    "app_imports": "import streamlit, metrics, auth, pages\n"
+    "import plotly.express, supabase",
+}
+IMPORT_PROBE = """
+import json, sys, time
+start = time.perf_counter()
+{code}
+print(json.dumps({{
+    "time": round(time.perf_counter() - start, 4),
+    "modules": [m for m in {modules!r} if m in sys.modules],
+}}))
+"""
+
+
+def measure_imports(runs: int = 5) -> dict[str, dict]:
+    """Best of `runs` fresh interpreters per stage"""
+    env = {
+        # Enough configuration for auth to load, nothing signs in
+        "ADMIN_USERNAME": "benchmark",
+        "ADMIN_PASSWORD_HASH": "pbkdf2_sha256:1:AA==:AA==",
+        "JWT_SECRET": "benchmark",
+        **os.environ,
+    }
+    results = {}
+    for name, code in IMPORT_STAGES.items():
+        probe = IMPORT_PROBE.format(code=code, modules=HEAVY_MODULES)
+        samples = [
+            json.loads(
+                subprocess.run(
+                    [sys.executable, "-c", probe],
+                    cwd=SRC_PATH,
+                    env=env,
+                    capture_output=True,
+                    check=True,
+                    text=True,
+                ).stdout.splitlines()[-1]
+            )
+            for _ in range(runs)
+        ]
+        results[name] = min(samples, key=lambda sample: sample["time"])
+    return results
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    regressions = []
+    for size, benchmarks in results.items():
+        for name, result in benchmarks.items():
+            expected = baseline.get(size, {}).get(name)
+            if expected is None:
+                continue
+            for metric in ("time", "peak_mb"):
+                if metric in result and metric in expected:
+                    limit = expected[metric] * (1 + tolerance) + SLACK[metric]
+                    if result[metric] > limit:
+                        regressions.append(
+                            f"{name}[{size}] {metric}: "
+                            f"{result[metric]} > {expected[metric]}"
+                        )
+            if result["requests"] > expected["requests"]:
+                regressions.append(
+                    f"{name}[{size}] requests: "
+                    f"{result['requests']} > {expected['requests']}"
+                )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES)
+    parser.add_argument("--no-memory", action="store_true")
+    parser.add_argument("--baseline", type=Path, default=BASELINE_PATH)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--compare", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=0.5)
+    parser.add_argument("--imports", action="store_true")
+    args = parser.parse_args()
+
+    if args.imports:
+        for name, result in measure_imports().items():
+            modules = ",".join(result["modules"]) or "-"
+            print(f"{name:>16} time={result['time']} heavy_modules={modules}")
+        return
+
+    results = {}
+    for size in args.sizes:
+        results[str(size)] = run_benchmarks(size, memory=not args.no_memory)
+        for name, result in results[str(size)].items():
+            metrics = " ".join(f"{key}={value}" for key, value in result.items())
+            print(f"{name:>16} {size:>9} {metrics}")
+
+    if args.save_baseline:
+        args.baseline.parent.mkdir(parents=True, exist_ok=True)
+        args.baseline.write_text(json.dumps(results, indent=2) + "\n")
+        print(f"Baseline saved to {args.baseline}")
+    if args.compare:
+        baseline = json.loads(args.baseline.read_text())
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
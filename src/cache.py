@@ -0,0 +1,156 @@
+import threading
+import time
+from concurrent.futures import Future
+from functools import wraps
+from typing import Any, Callable, Hashable
+
+
+class Load:
+    """A value being loaded, readers of the same entry wait on `future`"""
+
+    def __init__(self, name: str, key: Hashable, generation: tuple[int, int]) -> None:
+        self.name = name
+        self.key = key
+        self.generation = generation
+        self.future: Future = Future()
+
+
+class TTLCache:
+    """Values are loaded outside the cache's lock, so a slow load only holds
+    up readers of the same entry, and they share it rather than load again."""
+
+    def __init__(self, ttl: float = 300) -> None:
+        self.ttl = ttl
+        self._entries: dict[tuple[str, Hashable], tuple[float, Any]] = {}
+        self._loads: dict[tuple[str, Hashable], Load] = {}
+        # Bumped on invalidation, a load started before one isn't cached
+        self._epoch = 0
+        self._generations: dict[str, int] = {}
+        self._swept = time.monotonic()
+        self._lock = threading.Lock()
+
+    def get_or_load(self, name: str, key: Hashable, loader: Callable[[], Any]) -> Any:
+        """Return the cached value for (name, key), loading it if missing or expired"""
+        with self._lock:
+            if self.is_fresh(name, key):
+                return self._entries[(name, key)][1]
+            load = self._loads.get((name, key))
+            loading = load is not None
+            if not loading:
+                load = self._claim(name, key)
+        if loading:
+            return load.future.result()
+        try:
+            value = loader()
+        except BaseException as e:
+            self.fail(load, e)
+            raise
+        self.fulfil(load, value)
+        return value
+
+    def claim(self, name: str, key: Hashable) -> Load | None:
+        """Take on loading (name, key), unless it's fresh or already being loaded.
+
+        The caller must pass the returned load to `fulfil` or `fail`."""
+        with self._lock:
+            if self.is_fresh(name, key) or (name, key) in self._loads:
+                return None
+            return self._claim(name, key)
+
+    def _claim(self, name: str, key: Hashable) -> Load:
+        load = Load(name, key, self._generation(name))
+        self._loads[(name, key)] = load
+        return load
+
+    def _generation(self, name: str) -> tuple[int, int]:
+        return self._epoch, self._generations.get(name, 0)
+
+    def fulfil(self, load: Load, value: Any) -> None:
+        with self._lock:
+            if self._loads.get((load.name, load.key)) is load:
+                del self._loads[(load.name, load.key)]
+            if self._generation(load.name) == load.generation:
+                self._store(load.name, load.key, value)
+        load.future.set_result(value)
+
+    def fail(self, load: Load, error: BaseException) -> None:
+        with self._lock:
+            if self._loads.get((load.name, load.key)) is load:
+                del self._loads[(load.name, load.key)]
+        load.future.set_exception(error)
+
+    def is_fresh(self, name: str, key: Hashable) -> bool:
+        entry = self._entries.get((name, key))
+        return entry is not None and time.monotonic() - entry[0] < self.ttl
+
+    def set(self, name: str, key: Hashable, value: Any) -> None:
+        with self._lock:
+            self._store(name, key, value)
+
+    def _store(self, name: str, key: Hashable, value: Any) -> None:
+        now = time.monotonic()
+        if now - self._swept >= self.ttl:
+            # Keys include filters, pages and dates, so expired entries would
+            # pile up until the next invalidation, which a worker never does.
+            # Swept at most once per ttl, none outlives it twice.
+            self._entries = {
+                k: entry
+                for k, entry in self._entries.items()
+                if now - entry[0] < self.ttl
+            }
+            self._swept = now
+        self._entries[(name, key)] = (now, value)
+
+    def invalidate(self, *names: str) -> None:
+        """Drop every cached value stored under the given names, or all if none.
+
+        Loads in progress finish for whoever is waiting on them, but aren't
+        cached and later readers load again."""
+        with self._lock:
+            if not names:
+                self._epoch += 1
+                self._entries.clear()
+                self._loads.clear()
+                return
+            for name in names:
+                self._generations[name] = self._generations.get(name, 0) + 1
+            for entry_key in [k for k in self._entries if k[0] in names]:
+                del self._entries[entry_key]
+            for load_key in [k for k in self._loads if k[0] in names]:
+                del self._loads[load_key]
+
+
+def cache_key(method_name: str, *args, **kwargs) -> Hashable:
+    return (method_name, args, tuple(sorted(kwargs.items())))
+
+
+def cached(name: str):
+    """Serve a method's result from `self.cache` until it expires or is invalidated"""
+
+    def decorator(method):
+        @wraps(method)
+        def wrapper(self, *args, **kwargs):
+            key = cache_key(method.__name__, *args, **kwargs)
+            return self.cache.get_or_load(
+                name, key, lambda: method(self, *args, **kwargs)
+            )
+
+        return wrapper
+
+    return decorator
+
+
+def invalidates(*names: str):
+    """Invalidate cached reads after a mutation, even if it fails midway"""
+
+    def decorator(method):
+        @wraps(method)
+        def wrapper(self, *args, **kwargs):
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                self.cache.invalidate(*names)
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,69 @@
+from functools import cached_property
+
+import pandas as pd
+
+# Words shorter than this, like "de" or "sa", say little about a category
+MIN_TOKEN_LENGTH = 3
+TOKEN_PATTERN = rf"[^\W\d_]{{{MIN_TOKEN_LENGTH},}}"
+# A title is assigned to a category once its words' summed weight for it is
+# above this, half of what a word only ever seen under it contributes, so a
+# word split evenly between two categories decides nothing alone
+MIN_SCORE = 0.5
+
+
+def tokenize(titles: pd.Series) -> pd.DataFrame:
+    """The distinct lowercase words of each title, one (row, token) per line"""
+    tokens = titles.astype("string").str.casefold().str.findall(TOKEN_PATTERN)
+    return (
+        tokens.explode()
+        .dropna()
+        .rename("token")
+        .rename_axis("row")
+        .reset_index()
+        .drop_duplicates()
+    )
+
+
+class TitleCategorizer:
+    """Guesses an entry's category from the words of its title.
+
+    Each word votes for the categories of the stored titles containing it,
+    in proportion to how often each was chosen, so a word seen under many
+    categories, like "payment", carries little weight. Nothing is learned
+    until the first prediction, imports that name every category skip it."""
+
+    def __init__(self, titles: pd.Series, categories: pd.Series) -> None:
+        self.titles = titles.reset_index(drop=True)
+        self.categories = pd.Series(
+            categories.astype(object).to_numpy(), name="category"
+        ).dropna()
+
+    @cached_property
+    def weights(self) -> pd.DataFrame:
+        """Weight of each (token, category) pair"""
+        tokens = tokenize(self.titles).merge(
+            self.categories, left_on="row", right_index=True
+        )
+        counts = tokens.groupby(["token", "category"]).size()
+        return (
+            (counts / counts.groupby(level="token").transform("sum"))
+            .rename("weight")
+            .reset_index()
+        )
+
+    def predict(self, titles: pd.Series) -> pd.Series:
+        """Most likely category name of each title, NA when its words don't
+        point to one clearly enough"""
+        scores = (
+            tokenize(titles)
+            .merge(self.weights, on="token")
+            .groupby(["row", "category"], as_index=False)["weight"]
+            .sum()
+        )
+        best = (
+            scores[scores["weight"] > MIN_SCORE]
+            .sort_values(["weight", "category"], ascending=[False, True])
+            .drop_duplicates("row")
+            .set_index("row")["category"]
+        )
+        return best.reindex(titles.index).astype(object)
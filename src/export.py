@@ -0,0 +1,186 @@
+"""Export entries to CSV, Parquet or XLSX files.
+
+Entries are read with iter_entries and written one batch at a time, so the
+ledger is never held as a whole DataFrame, let alone next to its serialized
+copy. CSV exports use the upload columns and can be imported back."""
+
+import logging
+import os
+import tempfile
+import time
+from datetime import date
+from typing import Iterator
+
+import httpx
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from postgrest.exceptions import APIError
+
+from storage import StorageBackend
+from utils import ENTRY_COLUMNS
+
+EXPORT_BATCH_SIZE = int(os.environ.get("EXPORT_BATCH_SIZE", 5000))
+# Exports left behind by sessions that ended are removed after this long
+EXPORT_MAX_AGE = float(os.environ.get("EXPORT_MAX_AGE", 6 * 3600))  # seconds
+EXPORT_PREFIX = "save-it-export-"
+# Rows in a worksheet, the header included
+XLSX_MAX_ROWS = 1_048_576
+# Extension and MIME type of each format
+EXPORT_FORMATS = {
+    "CSV": ("csv", "text/csv"),
+    "Parquet": ("parquet", "application/vnd.apache.parquet"),
+    "XLSX": (
+        "xlsx",
+        "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    ),
+}
+PARQUET_SCHEMA = pa.schema(
+    [
+        ("type", pa.string()),
+        ("title", pa.string()),
+        ("category", pa.string()),
+        ("amount", pa.float64()),
+        ("date", pa.date32()),
+    ]
+)
+
+logger = logging.getLogger(__name__)
+
+
+class CsvExport:
+    def __init__(self, path: str) -> None:
+        self.file = open(path, "w", newline="", encoding="utf-8")
+        pd.DataFrame(columns=ENTRY_COLUMNS).to_csv(self.file, index=False)
+
+    def write(self, batch: pd.DataFrame):
+        batch.to_csv(self.file, header=False, index=False, date_format="%Y-%m-%d")
+
+    def close(self):
+        self.file.close()
+
+
+class ParquetExport:
+    """One row group per batch"""
+
+    def __init__(self, path: str) -> None:
+        self.writer = pq.ParquetWriter(path, PARQUET_SCHEMA)
+
+    def write(self, batch: pd.DataFrame):
+        self.writer.write_table(
+            pa.Table.from_pandas(batch, schema=PARQUET_SCHEMA, preserve_index=False)
+        )
+
+    def close(self):
+        self.writer.close()
+
+
+class XlsxExport:
+    """Rows are flushed to a temporary file as soon as the next one starts,
+    xlsxwriter's constant memory mode. Entries that don't fit in a sheet
+    continue in another, "Entries 2" and so on."""
+
+    def __init__(self, path: str) -> None:
+        import xlsxwriter
+
+        self.workbook = xlsxwriter.Workbook(path, {"constant_memory": True})
+        self.date_format = self.workbook.add_format({"num_format": "yyyy-mm-dd"})
+        self.amount_format = self.workbook.add_format({"num_format": "#,##0.00"})
+        self.header_format = self.workbook.add_format({"bold": True})
+        self.sheets = 0
+        self._add_sheet()
+
+    def _add_sheet(self):
+        self.sheets += 1
+        name = "Entries" if self.sheets == 1 else f"Entries {self.sheets}"
+        self.sheet = self.workbook.add_worksheet(name)
+        self.sheet.write_row(
+            0, 0, [col.capitalize() for col in ENTRY_COLUMNS], self.header_format
+        )
+        self.sheet.set_column(1, 2, 24)
+        self.sheet.set_column(4, 4, 12)
+        self.sheet.freeze_panes(1, 0)
+        self.row = 1
+
+    def write(self, batch: pd.DataFrame):
+        rows = zip(
+            batch["type"].astype(str).tolist(),
+            batch["title"].astype(str).tolist(),
+            batch["category"].astype(str).tolist(),
+            batch["amount"].tolist(),
+            batch["date"].tolist(),
+        )
+        for type, title, category, amount, day in rows:
+            if self.row == XLSX_MAX_ROWS:
+                # Past the last row xlsxwriter returns -1 and drops the cell
+                self._add_sheet()
+            self.sheet.write_string(self.row, 0, type)
+            self.sheet.write_string(self.row, 1, title)
+            self.sheet.write_string(self.row, 2, category)
+            self.sheet.write_number(self.row, 3, amount, self.amount_format)
+            self.sheet.write_datetime(self.row, 4, day, self.date_format)
+            self.row += 1
+
+    def close(self):
+        self.workbook.close()
+
+
+WRITERS = {"CSV": CsvExport, "Parquet": ParquetExport, "XLSX": XlsxExport}
+
+
+def export_file_name(format: str) -> str:
+    extension, _ = EXPORT_FORMATS[format]
+    return f"save-it-{date.today().isoformat()}.{extension}"
+
+
+def export_entries(
+    client: StorageBackend,
+    path: str,
+    format: str,
+    batch_size: int = EXPORT_BATCH_SIZE,
+    **filters,
+) -> Iterator[int]:
+    """Write every entry matching `filters`, see iter_entries, to `path` in
+    (date, id) order. Yields the number of entries written after each batch."""
+    if client.write_queue is not None:
+        # Queued edits would otherwise be missing from the file
+        try:
+            while client.write_queue.flush() == client.write_queue.batch_size:
+                pass
+        except (APIError, httpx.HTTPError) as e:
+            # Offline, export what is stored
+            logger.warning("Exporting without the queued changes: %s", e)
+    writer = WRITERS[format](path)
+    written = 0
+    try:
+        for batch in client.iter_entries(batch_size=batch_size, **filters):
+            writer.write(batch[ENTRY_COLUMNS])
+            written += len(batch)
+            yield written
+    finally:
+        writer.close()
+
+
+def temporary_export_path(format: str) -> str:
+    remove_stale_exports()
+    extension, _ = EXPORT_FORMATS[format]
+    fd, path = tempfile.mkstemp(prefix=EXPORT_PREFIX, suffix=f".{extension}")
+    os.close(fd)
+    return path
+
+
+def remove_stale_exports(max_age: float = EXPORT_MAX_AGE) -> int:
+    """Delete exports older than `max_age` seconds, returns how many"""
+    removed = 0
+    cutoff = time.time() - max_age
+    for entry in os.scandir(tempfile.gettempdir()):
+        if not entry.name.startswith(EXPORT_PREFIX):
+            continue
+        try:
+            if entry.stat().st_mtime < cutoff:
+                os.remove(entry.path)
+                removed += 1
+        except FileNotFoundError:
+            # Removed by another session meanwhile
+            pass
+    return removed
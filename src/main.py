@@ -1,19 +1,42 @@
+import os
+
 import streamlit as st
 
-import pages
-from auth import Authenticator
+import metrics
+from auth import authenticator
+
+debug_panel = os.environ.get("DEBUG_PANEL", "false").lower() == "true"
 
 if __name__ == "__main__":
-    st.set_page_config(page_title="Expense Tracker", page_icon="💰", layout="wide")
-    st.title("Expense Tracker")
-    auth = Authenticator()
-    auth.check_authentication()
-    auth.logout()
+    with metrics.trace_rerun() as trace:
+        st.set_page_config(page_title="Expense Tracker", page_icon="💰", layout="wide")
+        st.title("Expense Tracker")
+        user = authenticator.check_authentication()
+        # Deferred until signed in, so the login form renders before pandas,
+        # plotly and the storage layer are imported
+        import pages
+        from supabase_client import current_user
+        from ui import render_debug_panel
+
+        current_user.set(user["user_id"])
+        authenticator.logout()
+        pages.prefetch_data()
+        pages.failed_writes_notice()
 
-    tab1, tab2, tab3 = st.tabs(["Add Entry", "My Expenses", "Upload CSV"])
-    with tab1:
-        pages.add_entry_page()
-    with tab2:
-        pages.expenses_page()
-    with tab3:
-        pages.upload_csv_page()
+        tabs = ["Add Entry", "My Expenses", "Trends", "Upload CSV"]
+        tab1, tab2, tab3, tab4, *admin_tabs = st.tabs(
+            tabs + ["Users"] if user["admin"] else tabs
+        )
+        with tab1:
+            pages.add_entry_page()
+        with tab2:
+            pages.expenses_page()
+        with tab3:
+            pages.trends_page()
+        with tab4:
+            pages.upload_csv_page()
+        if admin_tabs:
+            with admin_tabs[0]:
+                pages.users_page()
+    if debug_panel and user["admin"]:
+        render_debug_panel(trace)
@@ -0,0 +1,144 @@
+"""Lightweight timers and counters for the hot paths of a rerun.
+
+Everything recorded is added to process-wide totals and, while a rerun is
+being traced, to that rerun's breakdown. Timings nest, so a parent's time
+includes its children's.
+"""
+
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from typing import Iterator
+
+# Append one JSON line per rerun, and rewrite a Prometheus textfile
+metrics_log_path = os.environ.get("METRICS_LOG_PATH")
+metrics_prom_path = os.environ.get("METRICS_PROM_PATH")
+
+
+class Trace:
+    def __init__(self) -> None:
+        self.timings: dict[str, list[float]] = {}  # name -> [seconds, calls]
+        self.counters: dict[str, float] = {}
+        self.started = time.perf_counter()
+        self.total = 0.0
+
+    def add_timing(self, name: str, seconds: float) -> None:
+        timing = self.timings.setdefault(name, [0.0, 0])
+        timing[0] += seconds
+        timing[1] += 1
+
+    def add_count(self, name: str, value: float) -> None:
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def to_dict(self) -> dict:
+        return {
+            "total": round(self.total, 6),
+            "timings": {
+                name: {"seconds": round(seconds, 6), "calls": calls}
+                for name, (seconds, calls) in self.timings.items()
+            },
+            "counters": dict(self.counters),
+        }
+
+
+_lock = threading.Lock()
+_export_lock = threading.Lock()
+_totals = Trace()
+_current: ContextVar[Trace | None] = ContextVar("trace", default=None)
+
+
+def record_timing(name: str, seconds: float) -> None:
+    with _lock:
+        _totals.add_timing(name, seconds)
+    trace = _current.get()
+    if trace is not None:
+        trace.add_timing(name, seconds)
+
+
+def count(name: str, value: float = 1) -> None:
+    with _lock:
+        _totals.add_count(name, value)
+    trace = _current.get()
+    if trace is not None:
+        trace.add_count(name, value)
+
+
+@contextmanager
+def timer(name: str) -> Iterator[None]:
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_timing(name, time.perf_counter() - start)
+
+
+def timed(name: str):
+    """Record every call of the decorated function under name"""
+
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with timer(name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+@contextmanager
+def trace_rerun() -> Iterator[Trace]:
+    """Collect a breakdown of everything recorded until the block exits,
+    then export it. Exits early, like st.stop(), are traced as well."""
+    trace = Trace()
+    token = _current.set(trace)
+    try:
+        yield trace
+    finally:
+        _current.reset(token)
+        trace.total = time.perf_counter() - trace.started
+        record_timing("rerun", trace.total)
+        export(trace)
+
+
+def totals() -> dict:
+    with _lock:
+        return _totals.to_dict()
+
+
+def export(trace: Trace) -> None:
+    with _export_lock:
+        if metrics_log_path:
+            line = json.dumps({"time": time.time(), **trace.to_dict()})
+            with open(metrics_log_path, "a") as log:
+                log.write(line + "\n")
+        if metrics_prom_path:
+            write_prometheus(metrics_prom_path)
+
+
+def write_prometheus(path: str) -> None:
+    """Write the totals in the Prometheus text format, for node_exporter's
+    textfile collector"""
+    stats = totals()
+    lines = [
+        "# HELP save_it_duration_seconds Time spent per instrumented step.",
+        "# TYPE save_it_duration_seconds summary",
+    ]
+    for name, timing in sorted(stats["timings"].items()):
+        labels = f'{{name="{name}"}}'
+        lines.append(f"save_it_duration_seconds_sum{labels} {timing['seconds']}")
+        lines.append(f"save_it_duration_seconds_count{labels} {timing['calls']}")
+    lines += [
+        "# HELP save_it_events_total Requests and bytes by source.",
+        "# TYPE save_it_events_total counter",
+    ]
+    for name, value in sorted(stats["counters"].items()):
+        lines.append(f'save_it_events_total{{name="{name}"}} {value}')
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        f.write("\n".join(lines) + "\n")
+    os.replace(tmp, path)
@@ -1,27 +1,64 @@
 import streamlit as st
+from postgrest.exceptions import APIError
 
-from supabase_client import SupabaseClient, with_supabase_client
-from ui import make_expenses_table, make_report
+from metrics import timed
+from passwords import hash_password
+from storage import StorageBackend
+from supabase_client import with_supabase_client
+from ui import make_expenses_table, make_export, make_report, make_trends
 
 
+@timed("pages.prefetch_data")
 @with_supabase_client()
-def expenses_page(client: SupabaseClient):
+def prefetch_data(client: StorageBackend):
+    client.prefetch()
+
+
+@with_supabase_client()
+def failed_writes_notice(client: StorageBackend):
+    """Queued changes the server kept rejecting are no longer shown as if
+    they were saved, so say so"""
+    failed = client.failed_writes()
+    if not failed:
+        return
+    st.warning(f"{len(failed)} of your changes were rejected and not saved.")
+    with st.expander("Rejected changes"):
+        st.dataframe(
+            [
+                {
+                    "change": change["op"],
+                    "entry": change["payload"].get("title")
+                    or change["payload"].get("id"),
+                    "error": change["error"],
+                }
+                for change in failed
+            ],
+            use_container_width=True,
+        )
+        if st.button("Dismiss"):
+            client.discard_failed_writes()
+            st.rerun()
+
+
+@with_supabase_client()
+def expenses_page(client: StorageBackend):
     st.header("My Expenses")
-    data = client.load_data()
-    if not data.empty:
-        expenses = data[data["type"] == "Expense"]
-        incomes = data[data["type"] == "Income"]
+    rollup = client.load_rollup()
+    if not rollup.empty:
+        categories = client.load_categories()
         table_col, report_col = st.columns([0.4, 0.6])
         with table_col:
-            expenses = make_expenses_table(expenses)
+            filters = make_expenses_table(categories)
+            with st.expander("Export"):
+                make_export(filters)
         with report_col:
-            make_report(incomes, expenses)
+            make_report(rollup)
     else:
         st.info("No data to display.")
 
 
 @with_supabase_client()
-def add_entry_page(client: SupabaseClient):
+def add_entry_page(client: StorageBackend):
     st.header("Add New Entry")
     categories = client.load_categories()
     entry_type = st.radio("Type", ["Expense", "Income"])
@@ -30,21 +67,87 @@ def add_entry_page(client: SupabaseClient):
     amount = st.number_input("Amount", min_value=0.0, format="%.2f")
     date = st.date_input("Date", format="YYYY/MM/DD")
     if st.button("Save Entry"):
-        if all([title, category, amount, date]):
-            category_id = int(
-                categories[categories["name"] == category]["id"].to_list()[0]
-            )
+        if not all([title, category, amount, date]):
+            st.error("Please fill all fields")
+        elif (category_id := client.category_id(category)) is None:
+            st.error(f"The category {category} no longer exists")
+        else:
             response = client.save_entry(entry_type, title, category_id, amount, date)
             if response.data:
                 st.success("Entry saved successfully!")
-        else:
-            st.error("Please fill all fields")
+
+
+def trends_page():
+    st.header("Trends")
+    make_trends()
 
 
 @with_supabase_client()
-def upload_csv_page(client: SupabaseClient):
+def upload_csv_page(client: StorageBackend):
     st.header("Upload CSV File")
     uploaded_file = st.file_uploader("Choose a CSV file", type="csv")
-    if uploaded_file is not None:
-        client.process_csv(uploaded_file)
-        st.success("CSV processed successfully!")
+    if uploaded_file is None:
+        return
+    # Preview once per upload, not on every rerun
+    preview = st.session_state.get("csv_preview")
+    if preview is None or preview["file_id"] != uploaded_file.file_id:
+        try:
+            preview = {
+                "file_id": uploaded_file.file_id,
+                **client.preview_csv(uploaded_file),
+            }
+        except ValueError as e:
+            st.error(f"Could not read the CSV file: {e}")
+            return
+        except APIError as e:
+            st.error(f"Could not check the CSV file against your entries: {e.message}")
+            return
+        st.session_state["csv_preview"] = preview
+    st.info(
+        f"{preview['new']} new entries, {preview['duplicates']} already imported "
+        f"and {preview['rejected']} invalid rows."
+    )
+    if preview["categorized"]:
+        st.caption(f"{preview['categorized']} entries were categorized by title.")
+    if preview["new_categories"]:
+        st.caption(f"New categories: {', '.join(preview['new_categories'])}")
+    if preview["new"] and st.button(f"Import {preview['new']} entries"):
+        uploaded_file.seek(0)
+        progress = st.progress(0.0, text="Importing entries...")
+        summary = {"inserted": 0, "duplicates": 0, "failed": 0}
+        try:
+            for chunk_summary in client.stream_csv(uploaded_file):
+                for key in summary:
+                    summary[key] += chunk_summary[key]
+                done = min(uploaded_file.tell() / max(uploaded_file.size, 1), 1.0)
+                progress.progress(
+                    done, text=f"Imported {summary['inserted']} entries so far..."
+                )
+        except APIError as e:
+            # Imported rows are skipped as duplicates when the file is imported again
+            st.error(f"Importing stopped: {e.message}")
+        progress.empty()
+        # The next rerun previews against the entries just added
+        del st.session_state["csv_preview"]
+        if summary["inserted"]:
+            st.success(f"Imported {summary['inserted']} entries successfully!")
+        if summary["duplicates"]:
+            st.warning(f"{summary['duplicates']} rows were already imported.")
+        if summary["failed"]:
+            st.error(f"{summary['failed']} rows could not be saved.")
+
+
+@with_supabase_client()
+def users_page(client: StorageBackend):
+    st.header("Users")
+    username = st.text_input("Username", key="new_username")
+    password = st.text_input("Password", type="password", key="new_password")
+    is_admin = st.checkbox("Admin")
+    if st.button("Add User"):
+        if not (username and password):
+            st.error("Please fill all fields")
+        elif client.load_user(username) is not None:
+            st.error(f"The username {username} is taken")
+        else:
+            client.add_user(username, hash_password(password), is_admin)
+            st.success(f"Added {username}, they can log in now")
@@ -0,0 +1,39 @@
+"""Password hashing, kept apart from utils so the login screen can check
+credentials without importing pandas."""
+
+import base64
+import hashlib
+import hmac
+import secrets
+
+# PBKDF2 rounds for password hashes, around a third of a second per login
+PASSWORD_HASH_ITERATIONS = 600_000
+
+
+def hash_password(password: str, iterations: int = PASSWORD_HASH_ITERATIONS) -> str:
+    """Salted PBKDF2-SHA256 hash, as pbkdf2_sha256:iterations:salt:hash.
+
+    Colons rather than dollar signs, which docker-compose would interpolate."""
+    salt = secrets.token_bytes(16)
+    digest = hashlib.pbkdf2_hmac("sha256", password.encode(), salt, iterations)
+    return ":".join(
+        [
+            "pbkdf2_sha256",
+            str(iterations),
+            base64.b64encode(salt).decode(),
+            base64.b64encode(digest).decode(),
+        ]
+    )
+
+
+def check_password(password: str, password_hash: str) -> bool:
+    """Check a password against hash_password's output, or a legacy unsalted
+    SHA-256 hex digest"""
+    if not password_hash.startswith("pbkdf2_sha256:"):
+        legacy = hashlib.sha256(password.encode()).hexdigest()
+        return hmac.compare_digest(legacy, password_hash)
+    _, iterations, salt, expected = password_hash.split(":")
+    digest = hashlib.pbkdf2_hmac(
+        "sha256", password.encode(), base64.b64decode(salt), int(iterations)
+    )
+    return hmac.compare_digest(base64.b64encode(digest).decode(), expected)
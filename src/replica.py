@@ -0,0 +1,138 @@
+import logging
+import os
+import tempfile
+import threading
+from typing import TYPE_CHECKING
+
+import httpx
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from postgrest.exceptions import APIError
+
+from utils import LEDGER_COLUMNS, format_expenses_df
+
+if TYPE_CHECKING:
+    from supabase_client import SupabaseClient
+
+REPLICA_SYNC_INTERVAL = 60.0  # seconds
+
+logger = logging.getLogger(__name__)
+
+
+class ReadReplica:
+    """Local Parquet copy of the expenses and categories tables.
+
+    A background thread brings it up to date with delta syncs every
+    `interval` seconds, and writes mark it stale so the next read syncs
+    first. The files are memory-mapped on startup, so a cold process can
+    serve reads before reaching Supabase, and its first sync is a delta."""
+
+    def __init__(
+        self,
+        client: "SupabaseClient",
+        path: str,
+        interval: float = REPLICA_SYNC_INTERVAL,
+    ) -> None:
+        self.client = client
+        self.path = path
+        self.interval = interval
+        self.expenses: pd.DataFrame = format_expenses_df(pd.DataFrame(), LEDGER_COLUMNS)
+        self.categories = pd.DataFrame(columns=["id", "name"])
+        self._ledger: pd.DataFrame | None = None
+        self._refresh_lock = threading.Lock()
+        # Bumped by writes, the copy is stale while _synced lags behind it
+        self._version = 1
+        self._synced = 0
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+        os.makedirs(path, exist_ok=True)
+        self.load()
+
+    def _file(self, table: str) -> str:
+        return os.path.join(self.path, f"{table}.parquet")
+
+    def load(self) -> bool:
+        """Read the replica files, if present, and resume syncing from them"""
+        try:
+            ledger = pq.read_table(self._file("expenses"), memory_map=True).to_pandas()
+            categories = pq.read_table(
+                self._file("categories"), memory_map=True
+            ).to_pandas()
+        except (FileNotFoundError, pa.ArrowInvalid):
+            return False
+        self.client.restore_ledger(ledger)
+        self._ledger = ledger
+        self.expenses = format_expenses_df(ledger, LEDGER_COLUMNS)
+        self.categories = categories
+        self._synced = self._version
+        return True
+
+    def refresh(self, only_if_stale: bool = False) -> bool:
+        """Sync with Supabase and persist the result, returns whether anything
+        changed. Failures are logged and the current copy is kept."""
+        with self._refresh_lock:
+            version = self._version
+            if only_if_stale and self._synced >= version:
+                # Another thread synced while this one waited for the lock
+                return False
+            try:
+                categories = self.client.fetch_categories()
+                ledger = self.client.sync_ledger()
+            except (APIError, httpx.HTTPError) as e:
+                logger.warning("Syncing the read replica failed: %s", e)
+                return False
+            self._synced = version
+            changed = not (
+                self._ledger is not None
+                and ledger.equals(self._ledger)
+                and categories.equals(self.categories)
+            )
+            if changed:
+                self._save("expenses", ledger)
+                self._save("categories", categories)
+                self._ledger = ledger
+                self.expenses = format_expenses_df(ledger, LEDGER_COLUMNS)
+                self.categories = categories
+        if changed:
+            # Outside the refresh lock, so readers waiting on it aren't held
+            # up any longer
+            self.client.cache.invalidate("expenses", "categories")
+        return changed
+
+    def _save(self, table: str, data: pd.DataFrame) -> None:
+        # Replace atomically, a crash mid-write leaves the previous copy intact.
+        # Other processes share the directory, each write gets its own file.
+        fd, tmp = tempfile.mkstemp(prefix=f"{table}.", suffix=".tmp", dir=self.path)
+        try:
+            with os.fdopen(fd, "wb") as file:
+                pq.write_table(pa.Table.from_pandas(data, preserve_index=False), file)
+            os.replace(tmp, self._file(table))
+        except BaseException:
+            os.remove(tmp)
+            raise
+
+    def mark_stale(self) -> None:
+        self._version += 1
+
+    def read(self) -> tuple[pd.DataFrame, pd.DataFrame]:
+        """Current expenses and categories, synced first if a write made them
+        stale or nothing was loaded yet"""
+        if self._synced < self._version:
+            self.refresh(only_if_stale=True)
+        return self.expenses, self.categories
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._run, name="read-replica", daemon=True
+            )
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.refresh()
+            self._stop.wait(self.interval)
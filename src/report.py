@@ -1,59 +1,447 @@
 import io
+import logging
 import os
 import smtplib
+import threading
 import time
-from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import date, datetime
 from email.mime.application import MIMEApplication
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
+from functools import lru_cache
+from multiprocessing import get_context
 
-import schedule
+import pandas as pd
+from reportlab.graphics import renderPDF
+from reportlab.graphics.charts.barcharts import VerticalBarChart
+from reportlab.graphics.shapes import Drawing
+from reportlab.lib import colors
+from reportlab.lib.pagesizes import A4
+from reportlab.pdfbase.pdfmetrics import stringWidth
 from reportlab.pdfgen import canvas
 
-from supabase_client import SupabaseClient
+from storage import StorageBackend
 
 # Email configuration
 EMAIL_ADDRESS = os.environ.get("EMAIL_ADDRESS")
 EMAIL_PASSWORD = os.environ.get("EMAIL_PASSWORD")
+SMTP_HOST = os.environ.get("SMTP_HOST", "smtp.gmail.com")
+SMTP_PORT = int(os.environ.get("SMTP_PORT", 465))
+SMTP_SSL = os.environ.get("SMTP_SSL", "true").lower() == "true"
+SEND_ATTEMPTS = 4
+SEND_BACKOFF = 5  # seconds, doubled after every failed attempt
+SMTP_CONCURRENCY = int(os.environ.get("SMTP_CONCURRENCY", 2))
+RENDER_PROCESSES = int(os.environ.get("RENDER_PROCESSES", os.cpu_count() or 1))
 
+PAGE_WIDTH, PAGE_HEIGHT = A4
+MARGIN = 50
+LINE_HEIGHT = 14
+TRANSACTION_COLUMNS = [("Date", 70), ("Type", 60), ("Title", 200), ("Category", 100)]
+AMOUNT_WIDTH = 65
+CHART_MONTHS = 24
 
-def generate_report(supabase_client: SupabaseClient):
-    data = supabase_client.load_data()
+logger = logging.getLogger(__name__)
 
-    # Create PDF
+
+class ReportWriter:
+    """Lays out a report top to bottom, starting a new page whenever the
+    current one is full. Only a batch of entries is in memory at a time, but
+    reportlab keeps every finished page until save() and the PDF is built in
+    one buffer, so memory still grows with the report (40-50MB for 100k
+    entries).
+
+    Text for a page is collected in a single text object, which is much
+    cheaper than one drawString call per table cell."""
+
+    def __init__(self, buffer: io.BytesIO, title: str) -> None:
+        self.canvas = canvas.Canvas(buffer, pagesize=A4, pageCompression=1)
+        self.canvas.setTitle(title)
+        self.title = title
+        self.page = 0
+        self.text_object = None
+        self.new_page()
+
+    def new_page(self):
+        if self.page:
+            self.canvas.drawText(self.text_object)
+            self.canvas.showPage()
+        self.page += 1
+        self.text_object = self.canvas.beginText()
+        self.font = None
+        self.draw(MARGIN, MARGIN / 2, self.title, size=8)
+        self.draw(PAGE_WIDTH - MARGIN, MARGIN / 2, f"Page {self.page}", 8, right=True)
+        self.y = PAGE_HEIGHT - MARGIN
+
+    def draw(
+        self,
+        x: float,
+        y: float,
+        text: str,
+        size: int = 9,
+        bold: bool = False,
+        right: bool = False,
+    ):
+        font = "Helvetica-Bold" if bold else "Helvetica"
+        if right:
+            x -= _width(text, font, size)
+        if self.font != (font, size):
+            self.font = (font, size)
+            self.text_object.setFont(font, size)
+        self.text_object.setTextOrigin(x, y)
+        self.text_object.textOut(text)
+
+    def ensure_space(self, height: float) -> bool:
+        """Start a new page if `height` does not fit, returning whether it did"""
+        if self.y - height < MARGIN:
+            self.new_page()
+            return True
+        return False
+
+    def heading(self, text: str, size: int = 14):
+        self.ensure_space(size * 3)
+        self.y -= size * 1.5
+        self.draw(MARGIN, self.y, text, size, bold=True)
+        self.y -= size * 0.5
+
+    def text(self, text: str, size: int = 10):
+        self.ensure_space(LINE_HEIGHT)
+        self.y -= LINE_HEIGHT
+        self.draw(MARGIN, self.y, text, size)
+
+    def row(self, cells: list[str], widths: list[float], bold: bool = False):
+        """Draw a table row, the last cell right-aligned as an amount"""
+        self.ensure_space(LINE_HEIGHT)
+        self.y -= LINE_HEIGHT
+        x = MARGIN
+        for cell, width in zip(cells[:-1], widths[:-1]):
+            self.draw(x, self.y, _fit(str(cell), width), bold=bold)
+            x += width
+        self.draw(x + widths[-1], self.y, cells[-1], bold=bold, right=True)
+
+    def drawing(self, drawing: Drawing):
+        self.ensure_space(drawing.height)
+        self.y -= drawing.height
+        renderPDF.draw(drawing, self.canvas, MARGIN, self.y)
+
+    def save(self):
+        self.canvas.drawText(self.text_object)
+        self.canvas.save()
+
+
+@lru_cache(maxsize=4096)
+def _width(text: str, font: str = "Helvetica", size: int = 9) -> float:
+    return stringWidth(text, font, size)
+
+
+@lru_cache(maxsize=4096)
+def _fit(text: str, width: float, size: int = 9) -> str:
+    """Truncate text to the column width"""
+    while len(text) > 1 and _width(text, size=size) > width - 4:
+        text = text[:-2] + "…"
+    return text
+
+
+def _euros(amount: float) -> str:
+    return f"{'-' if amount < 0 else ''}€{abs(amount):,.2f}"
+
+
+def monthly_chart(savings: pd.DataFrame) -> Drawing:
+    recent = savings.tail(CHART_MONTHS)
+    drawing = Drawing(PAGE_WIDTH - 2 * MARGIN, 200)
+    chart = VerticalBarChart()
+    chart.x, chart.y = 40, 30
+    chart.width, chart.height = drawing.width - 60, 150
+    chart.data = [recent["income"].to_list(), recent["expenses"].to_list()]
+    chart.categoryAxis.categoryNames = recent["month"].dt.strftime("%m/%y").to_list()
+    chart.categoryAxis.labels.angle = 45
+    chart.categoryAxis.labels.boxAnchor = "ne"
+    chart.categoryAxis.labels.fontSize = 6
+    chart.valueAxis.valueMin = 0
+    chart.valueAxis.labels.fontSize = 7
+    chart.bars[0].fillColor = colors.seagreen
+    chart.bars[1].fillColor = colors.indianred
+    drawing.add(chart)
+    return drawing
+
+
+def write_summary(writer: ReportWriter, savings: pd.DataFrame):
+    writer.heading("Summary")
+    widths = [200, 100]
+    for label, column in [
+        ("Total income", "income"),
+        ("Total expenses", "expenses"),
+        ("Savings", "savings"),
+    ]:
+        writer.row([label, _euros(savings[column].sum())], widths)
+    if not savings.empty:
+        writer.drawing(monthly_chart(savings))
+
+
+def write_monthly_table(writer: ReportWriter, savings: pd.DataFrame):
+    writer.heading("Monthly totals")
+    widths = [100, 100, 100, 100]
+    header = ["Month", "Income", "Expenses", "Savings"]
+    writer.row(header, widths, bold=True)
+    for month in savings.itertuples(index=False):
+        if writer.ensure_space(LINE_HEIGHT):
+            writer.row(header, widths, bold=True)
+        writer.row(
+            [
+                month.month.strftime("%B %Y"),
+                _euros(month.income),
+                _euros(month.expenses),
+                _euros(month.savings),
+            ],
+            widths,
+        )
+
+
+def write_category_table(writer: ReportWriter, categories: pd.DataFrame):
+    writer.heading("Expenses by category")
+    widths = [200, 100, 100]
+    total = categories["amount"].sum()
+    writer.row(["Category", "Share", "Amount"], widths, bold=True)
+    for category in categories.itertuples(index=False):
+        share = category.amount / total if total else 0
+        writer.row([category.category, f"{share:.1%}", _euros(category.amount)], widths)
+
+
+def write_transactions(writer: ReportWriter, batches):
+    writer.heading("Transactions")
+    widths = [width for _, width in TRANSACTION_COLUMNS] + [AMOUNT_WIDTH]
+    header = [name for name, _ in TRANSACTION_COLUMNS] + ["Amount"]
+    writer.row(header, widths, bold=True)
+    for batch in batches:
+        for entry in batch.itertuples(index=False):
+            if writer.ensure_space(LINE_HEIGHT):
+                writer.row(header, widths, bold=True)
+            writer.row(
+                [
+                    entry.date.strftime("%Y-%m-%d"),
+                    entry.type,
+                    entry.title,
+                    entry.category,
+                    _euros(entry.amount),
+                ],
+                widths,
+            )
+
+
+def generate_report(
+    supabase_client: StorageBackend,
+    start_date: date | None = None,
+    end_date: date | None = None,
+) -> io.BytesIO:
+    """Render a PDF report for the period from aggregated data, streaming the
+    transaction listing in batches"""
+    period = " to ".join(
+        d.isoformat() for d in (start_date, end_date) if d is not None
+    ) or "All time"
     buffer = io.BytesIO()
-    c = canvas.Canvas(buffer)
-    c.drawString(100, 750, f"Expense Report - {datetime.now().strftime('%Y-%m-%d')}")
+    writer = ReportWriter(
+        buffer, f"Expense Report - {datetime.now().strftime('%Y-%m-%d')}"
+    )
+    writer.heading(writer.title, size=18)
+    writer.text(f"Period: {period}")
 
-    # Add more report content here
+    savings = supabase_client.load_savings_series(start_date, end_date)
+    write_summary(writer, savings)
+    write_monthly_table(writer, savings)
+    write_category_table(
+        writer, supabase_client.load_category_totals(start_date, end_date)
+    )
+    write_transactions(
+        writer, supabase_client.iter_entries(start_date=start_date, end_date=end_date)
+    )
 
-    c.save()
+    writer.save()
     buffer.seek(0)
     return buffer
 
 
-def send_email_report():
-    pdf_buffer = generate_report()
-
+def build_report_message(
+    pdf_buffer: io.BytesIO, period: str, recipient: str | None = None
+) -> MIMEMultipart:
     msg = MIMEMultipart()
-    msg["Subject"] = f"Weekly Expense Report - {datetime.now().strftime('%Y-%m-%d')}"
+    msg["Subject"] = f"{period} Expense Report - {datetime.now().strftime('%Y-%m-%d')}"
     msg["From"] = EMAIL_ADDRESS
-    msg["To"] = EMAIL_ADDRESS
+    msg["To"] = recipient or EMAIL_ADDRESS
 
-    text_part = MIMEText("Please find attached your weekly expense report.", "plain")
+    text_part = MIMEText(
+        f"Please find attached your {period.lower()} expense report.", "plain"
+    )
     pdf_part = MIMEApplication(pdf_buffer.getvalue(), Name="expense_report.pdf")
     pdf_part["Content-Disposition"] = 'attachment; filename="expense_report.pdf"'
 
     msg.attach(text_part)
     msg.attach(pdf_part)
+    return msg
+
 
-    with smtplib.SMTP_SSL("smtp.gmail.com", 465) as smtp:
+def connect_smtp() -> smtplib.SMTP:
+    if SMTP_SSL:
+        smtp = smtplib.SMTP_SSL(SMTP_HOST, SMTP_PORT)
+    else:
+        smtp = smtplib.SMTP(SMTP_HOST, SMTP_PORT)
+    if EMAIL_PASSWORD:
         smtp.login(EMAIL_ADDRESS, EMAIL_PASSWORD)
-        smtp.send_message(msg)
+    return smtp
+
+
+class SMTPSessionPool:
+    """One authenticated SMTP session per sending thread, reused for every
+    message that thread sends and closed when the pool is"""
+
+    def __init__(self) -> None:
+        self._local = threading.local()
+        self._sessions: list[smtplib.SMTP] = []
+        self._lock = threading.Lock()
+
+    def get(self) -> smtplib.SMTP:
+        smtp = getattr(self._local, "smtp", None)
+        if smtp is None:
+            smtp = connect_smtp()
+            self._local.smtp = smtp
+            with self._lock:
+                self._sessions.append(smtp)
+        return smtp
+
+    def discard(self):
+        """Drop this thread's session, e.g. after the server hung up"""
+        smtp = getattr(self._local, "smtp", None)
+        self._local.smtp = None
+        if smtp is not None:
+            with self._lock:
+                self._sessions.remove(smtp)
+            _quit(smtp)
+
+    def close(self):
+        with self._lock:
+            sessions, self._sessions = self._sessions, []
+        for smtp in sessions:
+            _quit(smtp)
+
+    def __enter__(self) -> "SMTPSessionPool":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _quit(smtp: smtplib.SMTP):
+    try:
+        smtp.quit()
+    except (smtplib.SMTPException, OSError):
+        smtp.close()
+
+
+def send_message(
+    msg: MIMEMultipart,
+    sessions: SMTPSessionPool | None = None,
+    attempts: int = SEND_ATTEMPTS,
+):
+    """Send a message, retrying transient SMTP and network errors with
+    exponential backoff on a fresh session"""
+    if sessions is None:
+        with SMTPSessionPool() as sessions:
+            return send_message(msg, sessions, attempts)
+    for attempt in range(attempts):
+        try:
+            sessions.get().send_message(msg)
+            return
+        except (smtplib.SMTPAuthenticationError, smtplib.SMTPRecipientsRefused):
+            raise
+        except (smtplib.SMTPException, OSError) as e:
+            sessions.discard()
+            if attempt == attempts - 1:
+                raise
+            delay = SEND_BACKOFF * 2**attempt
+            logger.warning("Sending report failed (%s), retrying in %ss", e, delay)
+            time.sleep(delay)
+
+
+def send_email_report(
+    supabase_client: StorageBackend,
+    period: str = "Weekly",
+    start_date: date | None = None,
+    end_date: date | None = None,
+):
+    pdf_buffer = generate_report(supabase_client, start_date, end_date)
+    send_message(build_report_message(pdf_buffer, period))
+
+
+@lru_cache
+def render_storage(user_id: int | None) -> StorageBackend:
+    from supabase_client import create_storage
+
+    return create_storage(user_id=user_id, read_only=True)
+
+
+def render_report(
+    start_date: date | None, end_date: date | None, user_id: int | None = None
+) -> bytes:
+    """Process pool entry point, each process renders with its own client"""
+    return generate_report(render_storage(user_id), start_date, end_date).getvalue()
+
+
+def render_reports(
+    supabase_client: StorageBackend,
+    periods: set[tuple[date | None, date | None]],
+    processes: int = RENDER_PROCESSES,
+) -> dict[tuple, bytes | Exception]:
+    """Render one report per period, in a process pool when there are several
+    since reportlab is CPU-bound"""
+    reports = {}
+    if len(periods) == 1 or processes <= 1:
+        for period in periods:
+            try:
+                reports[period] = generate_report(supabase_client, *period).getvalue()
+            except Exception as e:
+                reports[period] = e
+        return reports
+    # spawn, so children don't inherit the parent's open HTTP connections
+    with ProcessPoolExecutor(processes, mp_context=get_context("spawn")) as pool:
+        futures = {
+            period: pool.submit(render_report, *period, supabase_client.user_id)
+            for period in periods
+        }
+        for period, future in futures.items():
+            try:
+                reports[period] = future.result()
+            except Exception as e:
+                reports[period] = e
+    return reports
+
 
+def send_batch_reports(
+    supabase_client: StorageBackend,
+    jobs: list[dict],
+    processes: int = RENDER_PROCESSES,
+    concurrency: int = SMTP_CONCURRENCY,
+) -> list[dict]:
+    """Render and email reports for many recipients and periods.
 
-# def schedule_reports():
-#     schedule.every().sunday.do(send_email_report)
-#     while True:
-#         schedule.run_pending()
-#         time.sleep(1)
+    Each job has a recipient, period label, start_date and end_date. Reports
+    are rendered once per distinct period and sent over at most `concurrency`
+    SMTP sessions, each logged in once. Returns one status per job."""
+    periods = {(job["start_date"], job["end_date"]) for job in jobs}
+    reports = render_reports(supabase_client, periods, processes)
+    statuses = [{**job, "status": "sent", "error": None} for job in jobs]
+    with SMTPSessionPool() as sessions, ThreadPoolExecutor(concurrency) as executor:
+        futures = {}
+        for i, job in enumerate(jobs):
+            report = reports[(job["start_date"], job["end_date"])]
+            if isinstance(report, Exception):
+                statuses[i].update(status="failed", error=f"Rendering failed: {report}")
+                continue
+            msg = build_report_message(
+                io.BytesIO(report), job["period"], job["recipient"]
+            )
+            futures[i] = executor.submit(send_message, msg, sessions)
+        for i, future in futures.items():
+            try:
+                future.result()
+            except Exception as e:
+                statuses[i].update(status="failed", error=str(e))
+    return statuses
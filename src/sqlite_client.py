@@ -0,0 +1,395 @@
+import sqlite3
+import threading
+from contextlib import contextmanager
+from datetime import date
+from functools import cache
+from typing import Iterator
+
+import pandas as pd
+from postgrest.base_request_builder import APIResponse
+from postgrest.exceptions import APIError
+
+from cache import cached, invalidates
+from storage import StorageBackend, as_updates
+from utils import LEDGER_COLUMNS, format_expenses_df, format_rollup_df
+
+SCHEMA = """
+create table if not exists users (
+    id integer primary key,
+    username text unique not null,
+    password_hash text not null,
+    is_admin integer not null default 0,
+    created_at text not null default (strftime('%Y-%m-%dT%H:%M:%fZ', 'now'))
+);
+
+-- Categories without an account are shared, the rest belong to one
+create table if not exists categories (
+    id integer primary key,
+    name text not null,
+    user_id integer references users (id)
+);
+
+create table if not exists expenses (
+    id integer primary key,
+    type text not null,
+    title text not null,
+    category integer not null references categories (id),
+    amount real not null,
+    date text not null,
+    updated_at text not null default (strftime('%Y-%m-%dT%H:%M:%fZ', 'now')),
+    idempotency_key text unique,
+    user_id integer references users (id)
+);
+
+create index if not exists expenses_date_idx on expenses (date);
+"""
+
+# Databases from before categories belonged to accounts
+SCOPE_CATEGORIES = """
+begin;
+create table categories_scoped (
+    id integer primary key,
+    name text not null,
+    user_id integer references users (id)
+);
+insert into categories_scoped (id, name) select id, name from categories;
+drop table categories;
+alter table categories_scoped rename to categories;
+commit;
+"""
+
+# Same rows as the get_expenses_with_categories RPC
+ENTRIES = """
+with entries as (
+    select e.id, e.type, e.title, c.name as category, e.amount, e.date,
+        e.updated_at, e.user_id, e.idempotency_key
+    from expenses e
+    join categories c on c.id = e.category
+)
+"""
+ENTRY_FIELDS = ["type", "title", "category", "amount", "date"]
+SORTABLE = {"id", *ENTRY_FIELDS}
+NOW = "strftime('%Y-%m-%dT%H:%M:%fZ', 'now')"
+
+
+@cache
+def _connect(path: str) -> tuple[sqlite3.Connection, threading.Lock]:
+    """One connection per database, shared by every thread and account, so
+    in-memory databases work"""
+    db = sqlite3.connect(path, check_same_thread=False)
+    db.row_factory = sqlite3.Row
+    db.execute("pragma foreign_keys = on")
+    if path != ":memory:":
+        db.execute("pragma journal_mode=wal")
+    with db:
+        db.executescript(SCHEMA)
+        columns = {row["name"] for row in db.execute("pragma table_info(expenses)")}
+        if "user_id" not in columns:
+            # Databases created before accounts existed
+            db.execute(
+                "alter table expenses add column user_id integer references users (id)"
+            )
+        db.execute(
+            "create index if not exists expenses_user_id_date_idx "
+            "on expenses (user_id, date)"
+        )
+        columns = {row["name"] for row in db.execute("pragma table_info(categories)")}
+        if "user_id" not in columns:
+            # Names used to be unique across accounts, and SQLite can't drop
+            # a constraint, so the table is rebuilt with the same ids
+            db.execute("pragma foreign_keys = off")
+            db.executescript(SCOPE_CATEGORIES)
+            db.execute("pragma foreign_keys = on")
+        # Shared categories have no account, coalesce keeps their names unique
+        db.execute(
+            "create unique index if not exists categories_user_id_name_idx "
+            "on categories (coalesce(user_id, 0), name)"
+        )
+    return db, threading.Lock()
+
+
+class SQLiteClient(StorageBackend):
+    """Storage in an embedded SQLite database, for running offline or in tests.
+
+    Mirrors the Supabase schema and RPCs, so it can stand in for
+    SupabaseClient anywhere. Pass ":memory:" for a database that lasts as
+    long as the process."""
+
+    def __init__(
+        self,
+        path: str,
+        ttl: float = 300,
+        write_queue_path: str | None = None,
+        user_id: int | None = None,
+    ) -> None:
+        self.path = path
+        self._db, self._lock = _connect(path)
+        super().__init__(ttl, write_queue_path, user_id)
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        """Hold the connection for one transaction, failures surface as APIError
+        like they do with Supabase"""
+        with self._lock:
+            try:
+                with self._db:
+                    yield self._db
+            except sqlite3.Error as e:
+                raise APIError({"message": str(e), "code": type(e).__name__}) from e
+
+    def _read(self, sql: str, params: tuple | dict = ()) -> pd.DataFrame:
+        with self._transaction() as db:
+            return pd.read_sql_query(sql, db, params=params)
+
+    def _execute(self, sql: str, rows: list[tuple | dict]) -> APIResponse:
+        with self._transaction() as db:
+            data = [dict(record) for row in rows for record in db.execute(sql, row)]
+        return APIResponse(data=data, count=None)
+
+    def load_user(self, username: str) -> dict | None:
+        users = self._read(
+            "select id, username, password_hash, is_admin from users "
+            "where username = ?",
+            (username,),
+        ).astype({"is_admin": bool})
+        return users.to_dict("records")[0] if not users.empty else None
+
+    def add_user(
+        self, username: str, password_hash: str, is_admin: bool = False
+    ) -> APIResponse:
+        return self._execute(
+            "insert into users (username, password_hash, is_admin) values (?, ?, ?) "
+            "returning id, username, is_admin",
+            [(username, password_hash, is_admin)],
+        )
+
+    def ensure_admin(self, username: str, password_hash: str) -> int:
+        with self._transaction() as db:
+            user_id = db.execute(
+                "insert into users (username, password_hash, is_admin) "
+                "values (?, ?, 1) on conflict (username) do update set "
+                "password_hash = excluded.password_hash, is_admin = 1 returning id",
+                (username, password_hash),
+            ).fetchone()[0]
+            db.execute(
+                "update expenses set user_id = ? where user_id is null", (user_id,)
+            )
+        self.cache.invalidate("expenses")
+        return user_id
+
+    @cached("categories")
+    def load_categories(self) -> pd.DataFrame:
+        if self.user_id is None:
+            return self._read("select id, name from categories")
+        # Shared categories and the account's own
+        return self._read(
+            "select id, name from categories where user_id is null or user_id = ?",
+            (self.user_id,),
+        )
+
+    @invalidates("categories")
+    def add_categories(self, categories: list[str]) -> APIResponse:
+        return self._execute(
+            "insert into categories (name, user_id) values (?, ?) "
+            "on conflict do nothing returning id, name",
+            [(category, self.user_id) for category in categories],
+        )
+
+    @invalidates("expenses")
+    def apply_mutations(self, op: str, payloads: list[dict]) -> APIResponse:
+        scoped = self.user_id is not None
+        owner = {"user_id": self.user_id} if scoped else {}
+        if op == "upsert":
+            op, payloads = "update", as_updates(payloads)
+        if op == "insert":
+            columns = ENTRY_FIELDS + ["idempotency_key", "user_id"]
+            rows = [
+                {"idempotency_key": None, "user_id": None, **p, **owner}
+                for p in payloads
+            ]
+            values = [f"date(:{c})" if c == "date" else f":{c}" for c in columns]
+            return self._execute(
+                f"insert into expenses ({', '.join(columns)}) "
+                f"values ({', '.join(values)}) "
+                "on conflict (idempotency_key) do nothing returning *",
+                rows,
+            )
+        owned = " and user_id = :user_id" if scoped else ""
+        if op == "delete":
+            return self._execute(
+                f"delete from expenses where id = :id{owned} returning *",
+                [{"id": payload["id"], **owner} for payload in payloads],
+            )
+        if op == "update":
+            data = []
+            for payload in payloads:
+                values = payload["values"]
+                unknown = set(values) - set(ENTRY_FIELDS)
+                if unknown:
+                    raise APIError({"message": f"Unknown columns {sorted(unknown)}"})
+                assignments = ", ".join(f"{c} = :{c}" for c in values)
+                data.extend(
+                    self._execute(
+                        f"update expenses set {assignments}, updated_at = {NOW} "
+                        f"where id = :id{owned} returning *",
+                        [{**values, "id": payload["id"], **owner}],
+                    ).data
+                )
+            return APIResponse(data=data, count=None)
+        raise ValueError(f"Unknown operation {op}")
+
+    @cached("expenses")
+    def _load_data(self) -> pd.DataFrame:
+        where, params = self._filters()
+        return format_expenses_df(
+            self._read(ENTRIES + f"select * from entries {where}", params),
+            LEDGER_COLUMNS,
+        )
+
+    @cached("expenses")
+    def load_monthly_totals(
+        self, start_date: date | None = None, end_date: date | None = None
+    ) -> pd.DataFrame:
+        where, params = self._filters(start_date=start_date, end_date=end_date)
+        data = self._read(
+            ENTRIES
+            + "select substr(date, 1, 7) || '-01' as month, type, category, "
+            f"sum(amount) as amount from entries {where} "
+            "group by 1, 2, 3 order by 1, 2, 3",
+            params,
+        )
+        return format_rollup_df(data)
+
+    @cached("expenses")
+    def load_category_totals(
+        self,
+        start_date: date | None = None,
+        end_date: date | None = None,
+        type: str = "Expense",
+    ) -> pd.DataFrame:
+        where, params = self._filters(type, start_date, end_date)
+        return self._read(
+            ENTRIES + "select category, sum(amount) as amount from entries "
+            f"{where} group by 1 order by 2 desc",
+            params,
+        )
+
+    @cached("expenses")
+    def load_daily_totals(
+        self,
+        start_date: date | None = None,
+        end_date: date | None = None,
+        type: str = "Expense",
+    ) -> pd.DataFrame:
+        where, params = self._filters(type, start_date, end_date)
+        return self._read(
+            ENTRIES + "select date, category, sum(amount) as amount from entries "
+            f"{where} group by 1, 2 order by 1, 2",
+            params,
+        )
+
+    @cached("expenses")
+    def load_savings_series(
+        self, start_date: date | None = None, end_date: date | None = None
+    ) -> pd.DataFrame:
+        where, params = self._filters(start_date=start_date, end_date=end_date)
+        savings = self._read(
+            ENTRIES
+            + """
+            select
+                substr(date, 1, 7) || '-01' as month,
+                total(case when type = 'Income' then amount end) as income,
+                total(case when type = 'Expense' then amount end) as expenses
+            from entries
+            """
+            + f"{where} group by 1 order by 1",
+            params,
+        )
+        savings["savings"] = savings["income"] - savings["expenses"]
+        savings["month"] = pd.to_datetime(savings["month"]).dt.to_period("M")
+        return savings
+
+    @cached("expenses")
+    def _query_entries(
+        self,
+        type: str | None = None,
+        start_date: date | None = None,
+        end_date: date | None = None,
+        categories: tuple[str, ...] = (),
+        order_by: str = "date",
+        ascending: bool = False,
+        page: int = 0,
+        page_size: int = 50,
+    ) -> tuple[pd.DataFrame, int]:
+        if order_by not in SORTABLE:
+            raise ValueError(f"Cannot sort by {order_by}")
+        where, params = self._filters(type, start_date, end_date, categories)
+        direction = "asc" if ascending else "desc"
+        with self._transaction() as db:
+            total = db.execute(
+                ENTRIES + f"select count(*) from entries {where}", params
+            ).fetchone()[0]
+            data = pd.read_sql_query(
+                ENTRIES + f"select * from entries {where} "
+                f"order by {order_by} {direction}, id {direction} "
+                "limit :limit offset :offset",
+                db,
+                params={**params, "limit": page_size, "offset": page * page_size},
+            )
+        return format_expenses_df(data), total
+
+    def iter_entries(
+        self,
+        type: str | None = None,
+        start_date: date | None = None,
+        end_date: date | None = None,
+        categories: tuple[str, ...] = (),
+        batch_size: int = 1000,
+    ) -> Iterator[pd.DataFrame]:
+        where, params = self._filters(type, start_date, end_date, categories)
+        after = " and " if where else "where "
+        after += "(date > :last_date or (date = :last_date and id > :last_id))"
+        last = None
+        while True:
+            batch = self._read(
+                ENTRIES + f"select * from entries {where}"
+                + (after if last is not None else "")
+                + " order by date, id limit :limit",
+                {**params, **(last or {}), "limit": batch_size},
+            )
+            if batch.empty:
+                return
+            last = {
+                "last_date": batch["date"].iloc[-1],
+                "last_id": int(batch["id"].iloc[-1]),
+            }
+            yield format_expenses_df(batch)
+            if len(batch) < batch_size:
+                return
+
+    def _filters(
+        self,
+        type: str | None = None,
+        start_date: date | None = None,
+        end_date: date | None = None,
+        categories: tuple[str, ...] = (),
+    ) -> tuple[str, dict]:
+        """Build the where clause over the entries CTE and its parameters"""
+        clauses, params = [], {}
+        if self.user_id is not None:
+            clauses.append("user_id = :user_id")
+            params["user_id"] = self.user_id
+        if type:
+            clauses.append("type = :type")
+            params["type"] = type
+        if start_date:
+            clauses.append("date >= :start_date")
+            params["start_date"] = start_date.isoformat()
+        if end_date:
+            clauses.append("date <= :end_date")
+            params["end_date"] = end_date.isoformat()
+        if categories:
+            names = {f"category_{i}": name for i, name in enumerate(categories)}
+            clauses.append(f"category in ({', '.join(':' + n for n in names)})")
+            params.update(names)
+        return ("where " + " and ".join(clauses)) if clauses else "", params
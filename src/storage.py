@@ -0,0 +1,460 @@
+from abc import ABC, abstractmethod
+from datetime import date, datetime
+from typing import Iterator
+
+import httpx
+import pandas as pd
+from postgrest.base_request_builder import APIResponse
+from postgrest.exceptions import APIError
+from pydantic import FilePath
+
+from cache import TTLCache, cached, invalidates
+from categorizer import TitleCategorizer
+from metrics import timed
+from trends import forecast_month_end, resample_spending, spending_series
+from utils import (
+    FingerprintIndex,
+    normalize_categories,
+    normalize_category,
+    normalize_entries_df,
+)
+from write_queue import WriteBehindQueue, add_pending_inserts, apply_pending
+
+IMPORT_CHUNK_SIZE = 500
+CSV_READ_SIZE = 10_000
+# Imported rows without a category the categorizer can't place either
+UNCATEGORIZED = "Uncategorized"
+
+
+class StorageBackend(ABC):
+    """Data access shared by every storage engine.
+
+    Subclasses implement the reads and `apply_mutations`, caching, the
+    write-behind queue and CSV imports are built on top of them here.
+    Failures are raised as postgrest's APIError whatever the engine.
+
+    Entries belong to the account `user_id`, every entry read and write is
+    scoped to it. Without one, they cover every account. Categories are the
+    shared ones plus the account's own, accounts themselves are shared."""
+
+    def __init__(
+        self,
+        ttl: float,
+        write_queue_path: str | None = None,
+        user_id: int | None = None,
+    ) -> None:
+        self.user_id = user_id
+        self.cache = TTLCache(ttl)
+        self.write_queue: WriteBehindQueue | None = None
+        if write_queue_path:
+            self.write_queue = WriteBehindQueue(self, write_queue_path)
+            self.write_queue.start()
+
+    def close(self):
+        """Stop the background threads, the write queue flushes once more on
+        its way out"""
+        if self.write_queue is not None:
+            self.write_queue.stop()
+
+    @abstractmethod
+    def load_user(self, username: str) -> dict | None:
+        """The account's id, username, password_hash and is_admin"""
+
+    @abstractmethod
+    def add_user(
+        self, username: str, password_hash: str, is_admin: bool = False
+    ) -> APIResponse: ...
+
+    @abstractmethod
+    def ensure_admin(self, username: str, password_hash: str) -> int:
+        """Create or update the configured admin's account, which takes over
+        entries that have no owner, and return its id"""
+
+    @abstractmethod
+    def load_categories(self) -> pd.DataFrame: ...
+
+    @abstractmethod
+    def add_categories(self, categories: list[str]) -> APIResponse:
+        """Create several categories in one request"""
+
+    @abstractmethod
+    def apply_mutations(self, op: str, payloads: list[dict]) -> APIResponse:
+        """Apply entry mutations, op is one of insert, delete or update. upsert,
+        which queued edits used to be, is applied as update."""
+
+    @abstractmethod
+    def _load_data(self) -> pd.DataFrame: ...
+
+    @abstractmethod
+    def load_monthly_totals(
+        self, start_date: date | None = None, end_date: date | None = None
+    ) -> pd.DataFrame:
+        """Totals per month, type and category"""
+
+    @abstractmethod
+    def load_category_totals(
+        self,
+        start_date: date | None = None,
+        end_date: date | None = None,
+        type: str = "Expense",
+    ) -> pd.DataFrame: ...
+
+    @abstractmethod
+    def load_daily_totals(
+        self,
+        start_date: date | None = None,
+        end_date: date | None = None,
+        type: str = "Expense",
+    ) -> pd.DataFrame:
+        """Totals per date and category"""
+
+    @abstractmethod
+    def load_savings_series(
+        self, start_date: date | None = None, end_date: date | None = None
+    ) -> pd.DataFrame: ...
+
+    @abstractmethod
+    def _query_entries(
+        self,
+        type: str | None = None,
+        start_date: date | None = None,
+        end_date: date | None = None,
+        categories: tuple[str, ...] = (),
+        order_by: str = "date",
+        ascending: bool = False,
+        page: int = 0,
+        page_size: int = 50,
+    ) -> tuple[pd.DataFrame, int]:
+        """Fetch one page of entries and the total number of matching entries"""
+
+    @abstractmethod
+    def iter_entries(
+        self,
+        type: str | None = None,
+        start_date: date | None = None,
+        end_date: date | None = None,
+        categories: tuple[str, ...] = (),
+        batch_size: int = 1000,
+    ) -> Iterator[pd.DataFrame]:
+        """Yield every matching entry in (date, id) order, one batch at a time"""
+
+    def add_category(self, category: str) -> APIResponse:
+        return self.add_categories([category])
+
+    @cached("categories")
+    def category_index(self) -> dict[str, int]:
+        """Category ids by normalize_category'd name, rebuilt whenever the
+        categories change"""
+        categories = self.load_categories()
+        return dict(
+            zip(normalize_categories(categories["name"]), categories["id"].astype(int))
+        )
+
+    def category_id(self, name: str) -> int | None:
+        return self.category_index().get(normalize_category(name))
+
+    def prefetch(self):
+        """Load the data every page needs up front"""
+        self.load_categories()
+        self.load_rollup()
+
+    def save_entry(
+        self,
+        type: str,
+        title: str,
+        category_id: str,
+        amount: float,
+        date: str | datetime,
+    ) -> APIResponse:
+        try:
+            date_str = date.isoformat()
+        except AttributeError:
+            date_str = date
+
+        entry = {
+            "type": type,
+            "title": title,
+            "category": category_id,
+            "amount": amount,
+            "date": date_str,
+        }
+        return self.write("insert", [entry])
+
+    def delete_entry(self, entry_id: int):
+        return self.write("delete", [{"id": entry_id}])
+
+    def delete_entries(self, entry_ids: list[int]) -> APIResponse:
+        return self.write("delete", [{"id": entry_id} for entry_id in entry_ids])
+
+    def update_entry(self, entry_id: int, updated_data: dict[str, str]) -> APIResponse:
+        return self.write("update", [{"id": entry_id, "values": updated_data}])
+
+    def update_entries(self, entries: list[dict]) -> APIResponse:
+        """Write several edited entries in one request, each must carry its id.
+        Entries deleted meanwhile stay deleted."""
+        return self.write("update", as_updates(entries))
+
+    @timed("storage.write")
+    def write(self, op: str, payloads: list[dict]) -> APIResponse:
+        """Apply entry mutations now, or queue them in write-behind mode"""
+        if self.write_queue is not None:
+            return self.write_queue.enqueue(op, payloads)
+        return self.apply_mutations(op, payloads)
+
+    def failed_writes(self) -> list[dict]:
+        """Queued mutations the server kept rejecting, see WriteBehindQueue"""
+        if self.write_queue is None:
+            return []
+        return self.write_queue.failed()
+
+    def discard_failed_writes(self) -> int:
+        if self.write_queue is None:
+            return 0
+        return self.write_queue.discard_failed()
+
+    @timed("storage.load_data")
+    def load_data(self) -> pd.DataFrame:
+        data = self._with_pending(self._load_data(), with_inserts=True)
+        return data.drop(columns="idempotency_key", errors="ignore")
+
+    def _with_pending(self, data: pd.DataFrame, with_inserts: bool = False):
+        if self.write_queue is None:
+            return data
+        categories = self.load_categories()
+        return apply_pending(
+            data,
+            self.write_queue.pending(),
+            dict(zip(categories["id"], categories["name"])),
+            with_inserts,
+        )
+
+    def load_rollup(self) -> pd.DataFrame:
+        """Monthly totals per type and category, with queued inserts added"""
+        rollup = self._load_rollup()
+        if self.write_queue is None:
+            return rollup
+        categories = self.load_categories()
+        return add_pending_inserts(
+            rollup,
+            self.write_queue.pending(),
+            dict(zip(categories["id"], categories["name"])),
+        )
+
+    @cached("expenses")
+    def _load_rollup(self) -> pd.DataFrame:
+        return self.load_monthly_totals()
+
+    @cached("expenses")
+    def load_spending_series(self, freq: str = "D") -> pd.DataFrame:
+        """Expenses per day, week ("W") or month ("M") and category, see
+        trends.spending_series. Kept until the entries change, so the trends
+        view only resamples once per granularity."""
+        if freq == "D":
+            return spending_series(self.load_daily_totals())
+        return resample_spending(self.load_spending_series("D"), freq)
+
+    @cached("expenses")
+    def load_month_end_forecast(self, today: date) -> pd.DataFrame:
+        """trends.forecast_month_end as of `today`"""
+        return forecast_month_end(self.load_spending_series("D"), pd.Timestamp(today))
+
+    @timed("storage.query_entries")
+    def query_entries(self, **filters) -> tuple[pd.DataFrame, int]:
+        """Fetch one page of entries, see _query_entries, with queued
+        mutations applied on top"""
+        data, total = self._query_entries(**filters)
+        return self._with_pending(data), total
+
+    def save_entries(self, entries: list[dict]) -> APIResponse:
+        # Imports are already batched, they bypass the write-behind queue
+        return self.apply_mutations("insert", entries)
+
+    def fingerprint_index(self, stored: pd.DataFrame) -> FingerprintIndex:
+        """Index of the stored entries, built once per import"""
+        category_ids = self.category_index()
+        stored = stored.assign(
+            category=normalize_categories(stored["category"]).map(category_ids)
+        ).dropna(subset=["category"])
+        scope = "" if self.user_id is None else str(self.user_id)
+        return FingerprintIndex(stored, scope)
+
+    def resolve_categories(
+        self,
+        df: pd.DataFrame,
+        categorizer: TitleCategorizer | None = None,
+        dry_run: bool = False,
+    ) -> tuple[pd.DataFrame, dict]:
+        """Fill in blank categories from the titles, falling back to
+        UNCATEGORIZED, then create the categories df names that don't exist
+        yet in one request.
+
+        Returns df with its categories filled in, and the category ids to
+        normalize it with along with which rows had no category, which of
+        those were categorized and which categories were created. A dry run
+        creates nothing and gives those categories placeholder ids."""
+        names = df.get("category", pd.Series(pd.NA, index=df.index)).astype(object)
+        # Collapse runs of whitespace, once per distinct name
+        spaced = {name: " ".join(name.split()) for name in names.dropna().unique()}
+        category = names.map(spaced).astype("string").replace("", pd.NA)
+        blank = category.isna()
+        categorized = pd.Series(False, index=df.index)
+        if categorizer is not None and blank.any() and "title" in df:
+            predicted = categorizer.predict(df.loc[blank, "title"])
+            categorized[blank] = predicted.notna()
+            category = category.fillna(predicted).fillna(UNCATEGORIZED)
+        df = df.assign(category=category)
+
+        category_ids = self.category_index()
+        names = category.dropna()
+        keys = normalize_categories(names)
+        unknown = names[~keys.isin(category_ids.keys()) & ~keys.duplicated()].tolist()
+        if unknown and dry_run:
+            placeholders = {normalize_category(name): -1 for name in unknown}
+            category_ids = {**category_ids, **placeholders}
+        elif unknown:
+            self.add_categories(unknown)
+            category_ids = self.category_index()
+        return df, {
+            "category_ids": category_ids,
+            "uncategorized": blank,
+            "categorized": categorized,
+            "new_categories": unknown,
+        }
+
+    @timed("storage.import_entries")
+    def import_entries(
+        self,
+        df: pd.DataFrame,
+        chunk_size: int = IMPORT_CHUNK_SIZE,
+        offset: int = 0,
+        index: FingerprintIndex | None = None,
+        categorizer: TitleCategorizer | None = None,
+        dry_run: bool = False,
+    ) -> dict:
+        """Insert the valid rows of df, skipping those `index` already holds
+        and categorizing those without a category. A dry run only counts
+        them."""
+        df, resolved = self.resolve_categories(df, categorizer, dry_run)
+        entries, rejected = normalize_entries_df(df, resolved["category_ids"])
+        duplicates = 0
+        if index is not None:
+            duplicate, keys = index.match(
+                entries, resolved["uncategorized"].reindex(entries.index)
+            )
+            entries = entries.assign(idempotency_key=keys)[~duplicate]
+            duplicates = int(duplicate.sum())
+
+        summary = {
+            "new": len(entries),
+            "inserted": 0,
+            "duplicates": duplicates,
+            "failed": 0,
+            "rejected": len(rejected),
+            # Only those going in, a duplicate was categorized when stored
+            "categorized": int(
+                resolved["categorized"].reindex(entries.index, fill_value=False).sum()
+            ),
+            "new_categories": resolved["new_categories"],
+            "chunks": [],
+        }
+        if dry_run:
+            return summary
+        records = entries.to_dict("records")
+        for start in range(0, len(records), chunk_size):
+            chunk = records[start : start + chunk_size]
+            try:
+                inserted = len(self.save_entries(chunk).data)
+                # Rows left out of the response hit an existing idempotency
+                # key, a concurrent or earlier run of the same import added them
+                skipped = len(chunk) - inserted if index is not None else 0
+                error = None
+            except (APIError, httpx.HTTPError) as e:
+                inserted = skipped = 0
+                error = str(e)
+            summary["inserted"] += inserted
+            summary["duplicates"] += skipped
+            summary["failed"] += len(chunk) - inserted - skipped
+            summary["chunks"].append(
+                {
+                    "start": offset + start,
+                    "rows": len(chunk),
+                    "inserted": inserted,
+                    "duplicates": skipped,
+                    "failed": len(chunk) - inserted - skipped,
+                    "error": error,
+                }
+            )
+        return summary
+
+    def stream_csv(
+        self,
+        csv_file: FilePath,
+        read_size: int = CSV_READ_SIZE,
+        chunk_size: int = IMPORT_CHUNK_SIZE,
+        deduplicate: bool = True,
+        categorize: bool = True,
+        dry_run: bool = False,
+    ) -> Iterator[dict]:
+        """Import a CSV file chunk by chunk, yielding a summary per chunk read.
+
+        Rows matching a stored entry are skipped unless deduplicate is off,
+        and rows without a category are categorized from their title, as
+        the stored entries were, unless categorize is off."""
+        stored = self.load_data()
+        index = self.fingerprint_index(stored) if deduplicate else None
+        categorizer = None
+        if categorize:
+            # Entries filed under the fallback say nothing about their titles
+            known = normalize_categories(stored["category"]) != normalize_category(
+                UNCATEGORIZED
+            )
+            categorizer = TitleCategorizer(
+                stored.loc[known, "title"], stored.loc[known, "category"]
+            )
+        offset = 0
+        with pd.read_csv(csv_file, chunksize=read_size, dtype=str) as reader:
+            for df in reader:
+                yield self.import_entries(
+                    df,
+                    chunk_size=chunk_size,
+                    offset=offset,
+                    index=index,
+                    categorizer=categorizer,
+                    dry_run=dry_run,
+                )
+                offset += len(df)
+
+    def preview_csv(self, csv_file: FilePath) -> dict:
+        """Count the new, duplicate and invalid rows of a CSV file without
+        importing anything"""
+        return merge_summaries(self.stream_csv(csv_file, dry_run=True))
+
+    @invalidates("expenses")
+    def process_csv(
+        self, csv_file: FilePath, chunk_size: int = IMPORT_CHUNK_SIZE
+    ) -> dict:
+        return merge_summaries(self.stream_csv(csv_file, chunk_size=chunk_size))
+
+
+def merge_summaries(summaries: Iterator[dict]) -> dict:
+    """Add up import_entries summaries"""
+    counts = ("new", "inserted", "duplicates", "failed", "rejected", "categorized")
+    summary = {key: 0 for key in counts} | {"new_categories": [], "chunks": []}
+    for chunk_summary in summaries:
+        for key in counts:
+            summary[key] += chunk_summary[key]
+        # Each chunk of a dry run reports the categories it would create
+        summary["new_categories"] = list(
+            dict.fromkeys(summary["new_categories"] + chunk_summary["new_categories"])
+        )
+        summary["chunks"].extend(chunk_summary["chunks"])
+    return summary
+
+
+def as_updates(entries: list[dict]) -> list[dict]:
+    """Edited entries as "update" payloads. Write queues may still hold edits
+    queued as "upsert", which carried the entries themselves."""
+    return [
+        {"id": entry["id"], "values": {k: v for k, v in entry.items() if k != "id"}}
+        for entry in entries
+    ]
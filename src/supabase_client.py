@@ -1,112 +1,584 @@
 import os
-from datetime import datetime
-from functools import partial, wraps
-from typing import Callable, ParamSpec, TypeVar
+import threading
+import time
+from collections import OrderedDict
+from contextvars import ContextVar
+from datetime import date
+from functools import cache, partial, wraps
+from typing import TYPE_CHECKING, Callable, Iterator, ParamSpec, TypeVar
 
+import httpx
 import pandas as pd
 from dotenv import load_dotenv
 from postgrest.base_request_builder import APIResponse
-from pydantic import FilePath
-from supabase import Client, create_client
+from postgrest.exceptions import APIError
+from postgrest.types import CountMethod
 
-from utils import format_expenses_df
+import metrics
+from async_supabase_client import get_async_client
+from cache import cache_key, cached, invalidates
+from replica import REPLICA_SYNC_INTERVAL, ReadReplica
+from sqlite_client import SQLiteClient
+from storage import StorageBackend, as_updates
+from utils import (
+    LEDGER_COLUMNS,
+    build_rollup,
+    format_expenses_df,
+    format_rollup_df,
+)
+
+if TYPE_CHECKING:
+    from supabase import Client
 
 load_dotenv()
 
 supabase_url = os.environ.get("SUPABASE_URL")
 supabase_key = os.environ.get("SUPABASE_KEY")
+cache_ttl = float(os.environ.get("CACHE_TTL_SECONDS", 300))
+write_behind = os.environ.get("WRITE_BEHIND", "false").lower() == "true"
+write_queue_path = os.environ.get("WRITE_QUEUE_PATH", "write_queue.sqlite3")
+storage_backend = os.environ.get("STORAGE_BACKEND", "supabase")
+sqlite_path = os.environ.get("SQLITE_PATH", "save_it.sqlite3")
+replica_path = os.environ.get("REPLICA_PATH")
+replica_interval = float(os.environ.get("REPLICA_SYNC_SECONDS", REPLICA_SYNC_INTERVAL))
+# Accounts whose storage, cache and threads are kept in memory at once
+max_storages = int(os.environ.get("MAX_ACCOUNT_STORAGES", 32))
+
+# Rows committed slightly before the cursor was taken may become visible later
+SYNC_OVERLAP = pd.Timedelta(seconds=5)
 
 P = ParamSpec("P")
 R = TypeVar("R")
 
 
-class SupabaseClient:
-    def __init__(self, url=supabase_url, key=supabase_key) -> None:
-        self.client: Client = create_client(url, key)
+class SupabaseClient(StorageBackend):
+    def __init__(
+        self,
+        url=supabase_url,
+        key=supabase_key,
+        ttl=cache_ttl,
+        incremental_sync: bool = True,
+        client: "Client | None" = None,
+        write_queue_path: str | None = write_queue_path if write_behind else None,
+        replica_path: str | None = replica_path,
+        user_id: int | None = None,
+    ) -> None:
+        self._client = client
+        self.url, self.key = (None, None) if client else (url, key)
+        self.incremental_sync = incremental_sync
+        self._ledger: pd.DataFrame | None = None
+        self._cursor: pd.Timestamp | None = None
+        # Loads run concurrently once one is invalidated, the cursor isn't shared
+        self._sync_lock = threading.Lock()
+        super().__init__(ttl, write_queue_path, user_id)
+        self.replica: ReadReplica | None = None
+        if replica_path:
+            self.replica = ReadReplica(self, replica_path, replica_interval)
+            self.replica.start()
 
-    def load_categories(self) -> pd.DataFrame:
-        response = self.client.table("categories").select("id,name").execute()
-        categories = pd.DataFrame(response.data)
-        return categories
+    def close(self):
+        super().close()
+        if self.replica is not None:
+            self.replica.stop()
 
-    def add_category(self, category: str):
-        return self.client.table("categories").insert({"name": category}).execute()
-
-    def save_entry(
-        self,
-        type: str,
-        title: str,
-        category_id: str,
-        amount: float,
-        date: str | datetime,
-    ) -> APIResponse:
-        try:
-            date_str = date.isoformat()
-        except AttributeError:
-            date_str = date
+    @property
+    def client(self) -> "Client":
+        # Built on first use, clients for the same project share one HTTP
+        # connection pool
+        if self._client is None:
+            self._client = get_client(self.url, self.key)
+        return self._client
 
+    def load_user(self, username: str) -> dict | None:
         response = (
-            self.client.table("expenses")
+            self.client.table("users")
+            .select("id,username,password_hash,is_admin")
+            .eq("username", username)
+            .limit(1)
+            .execute()
+        )
+        return response.data[0] if response.data else None
+
+    def add_user(
+        self, username: str, password_hash: str, is_admin: bool = False
+    ) -> APIResponse:
+        return (
+            self.client.table("users")
             .insert(
                 {
-                    "type": type,
-                    "title": title,
-                    "category": category_id,
-                    "amount": amount,
-                    "date": date_str,
+                    "username": username,
+                    "password_hash": password_hash,
+                    "is_admin": is_admin,
                 }
             )
             .execute()
         )
-        return response
 
-    def delete_entry(self, entry_id: int):
-        response = self.client.table("expenses").delete().eq("id", entry_id).execute()
-        return response
+    def ensure_admin(self, username: str, password_hash: str) -> int:
+        response = (
+            self.client.table("users")
+            .upsert(
+                {"username": username, "password_hash": password_hash, "is_admin": True},
+                on_conflict="username",
+            )
+            .execute()
+        )
+        user_id = response.data[0]["id"]
+        self.client.table("expenses").update({"user_id": user_id}).is_(
+            "user_id", "null"
+        ).execute()
+        return user_id
+
+    @cached("categories")
+    def load_categories(self) -> pd.DataFrame:
+        if self.replica is not None:
+            return self.replica.read()[1]
+        return self.fetch_categories()
+
+    def fetch_categories(self) -> pd.DataFrame:
+        response = self._visible_categories(
+            self.client.table("categories").select("id,name")
+        ).execute()
+        categories = pd.DataFrame(response.data, columns=["id", "name"])
+        return categories
 
-    def update_entry(self, entry_id: int, updated_data: dict[str, str]) -> APIResponse:
+    def prefetch(self):
+        """Load the data every page needs concurrently, so the pages that
+        follow are served from the cache instead of fetching in series"""
+        if self.replica is not None:
+            return super().prefetch()
+        loads = {
+            ("categories", "load_categories"): lambda c: c.load_categories(
+                user_id=self.user_id
+            ),
+            ("expenses", "_load_rollup"): lambda c: c.load_monthly_totals(
+                user_id=self.user_id
+            ),
+        }
+        if self.url is None:
+            # An injected client has no async counterpart
+            for name, method in loads:
+                getattr(self, method)()
+            return
+        claims = {
+            (name, method): self.cache.claim(name, cache_key(method))
+            for name, method in loads
+        }
+        # Fresh or being loaded by another session already
+        missing = {load: claim for load, claim in claims.items() if claim is not None}
+        if not missing:
+            return
+        async_client = get_async_client(self.url, self.key)
+        try:
+            values = async_client.gather(
+                *(loads[load](async_client) for load in missing)
+            )
+        except BaseException as e:
+            for claim in missing.values():
+                self.cache.fail(claim, e)
+            raise
+        for claim, value in zip(missing.values(), values):
+            self.cache.fulfil(claim, value)
+
+    @invalidates("categories")
+    def add_categories(self, categories: list[str]) -> APIResponse:
+        # Another session may have added some meanwhile, skip those
         response = (
-            self.client.table("expenses")
-            .update(updated_data)
-            .eq("id", entry_id)
+            self.client.table("categories")
+            .upsert(
+                [
+                    {"name": category, "user_id": self.user_id}
+                    for category in categories
+                ],
+                on_conflict="user_id,name",
+                ignore_duplicates=True,
+            )
             .execute()
         )
+        if self.replica is not None:
+            self.replica.mark_stale()
         return response
 
-    def load_data(self) -> pd.DataFrame:
-        response: APIResponse = self.client.rpc(
-            "get_expenses_with_categories"
-        ).execute()
-        data = pd.DataFrame(response.data)
-        formatted_data = format_expenses_df(data)
+    @invalidates("expenses")
+    def apply_mutations(self, op: str, payloads: list[dict]) -> APIResponse:
+        try:
+            return self._mutate(op, payloads)
+        finally:
+            if self.replica is not None:
+                self.replica.mark_stale()
+
+    def _mutate(self, op: str, payloads: list[dict]) -> APIResponse:
+        table = self.client.table("expenses")
+        if op == "upsert":
+            op, payloads = "update", as_updates(payloads)
+        if op == "insert":
+            if self.user_id is not None:
+                payloads = [{**p, "user_id": self.user_id} for p in payloads]
+            if "idempotency_key" in payloads[0]:
+                return table.upsert(
+                    payloads, on_conflict="idempotency_key", ignore_duplicates=True
+                ).execute()
+            return table.insert(payloads).execute()
+        if op == "delete":
+            ids = [payload["id"] for payload in payloads]
+            return self._scoped(table.delete().in_("id", ids)).execute()
+        if op == "update":
+            # One request for all of them, later edits of an entry win as they
+            # would one by one
+            edits: dict[int, dict] = {}
+            for payload in payloads:
+                values = edits.setdefault(payload["id"], {})
+                values.update(payload["values"])
+            return self.client.rpc(
+                "update_entries",
+                {
+                    "entries": [{**values, "id": id} for id, values in edits.items()],
+                    "for_user": self.user_id,
+                },
+            ).execute()
+        raise ValueError(f"Unknown operation {op}")
+
+    @cached("expenses")
+    def _load_data(self) -> pd.DataFrame:
+        if self.replica is not None:
+            return self.replica.read()[0]
+        data = self.sync_ledger()
+        formatted_data = format_expenses_df(data, LEDGER_COLUMNS)
         return formatted_data
 
-    def process_csv(self, csv_file: FilePath):
-        df = pd.read_csv(csv_file)
-        categories = self.load_categories()
-        response = None
-        for _, row in df.iterrows():
-            category_id = categories[categories["name"] == row["category"]][
-                "id"
-            ].to_list()[0]
-            response = self.save_entry(
-                row["type"],
-                row["title"],
-                category_id,
-                row["amount"],
-                row["date"],  # YYYY/MM/DD
+    @cached("expenses")
+    def _load_rollup(self) -> pd.DataFrame:
+        """Aggregated locally from the replica if there is one, else by Postgres"""
+        if self.replica is not None:
+            return build_rollup(self.replica.read()[0])
+        return self.load_monthly_totals()
+
+    @cached("expenses")
+    def load_monthly_totals(
+        self, start_date: date | None = None, end_date: date | None = None
+    ) -> pd.DataFrame:
+        """Totals per month, type and category, aggregated by Postgres"""
+        response = self._aggregate("get_monthly_totals", start_date, end_date)
+        return format_rollup_df(pd.DataFrame(response.data))
+
+    @cached("expenses")
+    def load_category_totals(
+        self,
+        start_date: date | None = None,
+        end_date: date | None = None,
+        type: str = "Expense",
+    ) -> pd.DataFrame:
+        response = self._aggregate(
+            "get_category_totals", start_date, end_date, entry_type=type
+        )
+        return pd.DataFrame(response.data, columns=["category", "amount"])
+
+    @cached("expenses")
+    def load_daily_totals(
+        self,
+        start_date: date | None = None,
+        end_date: date | None = None,
+        type: str = "Expense",
+    ) -> pd.DataFrame:
+        if self.replica is not None:
+            expenses = self.replica.read()[0]
+            expenses = expenses[expenses["type"] == type]
+            if start_date:
+                expenses = expenses[expenses["date"] >= pd.Timestamp(start_date)]
+            if end_date:
+                expenses = expenses[expenses["date"] <= pd.Timestamp(end_date)]
+            return (
+                expenses.groupby(["date", "category"], observed=True)["amount"]
+                .sum()
+                .reset_index()
             )
-        return response
+        response = self._aggregate(
+            "get_daily_totals", start_date, end_date, entry_type=type
+        )
+        return pd.DataFrame(response.data, columns=["date", "category", "amount"])
+
+    @cached("expenses")
+    def load_savings_series(
+        self, start_date: date | None = None, end_date: date | None = None
+    ) -> pd.DataFrame:
+        response = self._aggregate("get_savings_series", start_date, end_date)
+        savings = pd.DataFrame(
+            response.data, columns=["month", "income", "expenses", "savings"]
+        )
+        savings["month"] = pd.to_datetime(savings["month"]).dt.to_period("M")
+        return savings
+
+    def _aggregate(
+        self,
+        function: str,
+        start_date: date | None,
+        end_date: date | None,
+        **params,
+    ) -> APIResponse:
+        params["start_date"] = start_date.isoformat() if start_date else None
+        params["end_date"] = end_date.isoformat() if end_date else None
+        params["for_user"] = self.user_id
+        return self.client.rpc(function, params).execute()
+
+    @cached("expenses")
+    def _query_entries(
+        self,
+        type: str | None = None,
+        start_date: date | None = None,
+        end_date: date | None = None,
+        categories: tuple[str, ...] = (),
+        order_by: str = "date",
+        ascending: bool = False,
+        page: int = 0,
+        page_size: int = 50,
+    ) -> tuple[pd.DataFrame, int]:
+        """Fetch one page of entries, filtered and sorted by PostgREST.
+
+        Returns the page and the total number of matching entries."""
+        query = self._filter_entries(
+            self.client.postgrest.rpc(
+                "get_expenses_with_categories", {}, count=CountMethod.exact
+            ),
+            type,
+            start_date,
+            end_date,
+            categories,
+        )
+        # Tie-break on id so rows don't shift between pages
+        query = query.order(order_by, desc=not ascending).order("id", desc=not ascending)
+        start = page * page_size
+        response = query.range(start, start + page_size - 1).execute()
+        data = format_expenses_df(pd.DataFrame(response.data))
+        return data, response.count or 0
+
+    def iter_entries(
+        self,
+        type: str | None = None,
+        start_date: date | None = None,
+        end_date: date | None = None,
+        categories: tuple[str, ...] = (),
+        batch_size: int = 1000,
+    ) -> Iterator[pd.DataFrame]:
+        """Yield every matching entry in (date, id) order, one batch at a time.
+
+        Uses keyset pagination and bypasses the cache, so memory is bounded by
+        batch_size no matter how large the ledger is."""
+        last = None
+        while True:
+            query = self._filter_entries(
+                self.client.rpc("get_expenses_with_categories"),
+                type,
+                start_date,
+                end_date,
+                categories,
+            )
+            if last is not None:
+                query = query.or_(
+                    f"date.gt.{last['date']},"
+                    f"and(date.eq.{last['date']},id.gt.{last['id']})"
+                )
+            response = query.order("date").order("id").limit(batch_size).execute()
+            if not response.data:
+                return
+            last = response.data[-1]
+            yield format_expenses_df(pd.DataFrame(response.data))
+            if len(response.data) < batch_size:
+                return
+
+    def _filter_entries(
+        self,
+        query,
+        type: str | None,
+        start_date: date | None,
+        end_date: date | None,
+        categories: tuple[str, ...],
+    ):
+        query = self._scoped(query)
+        if type:
+            query = query.eq("type", type)
+        if start_date:
+            query = query.gte("date", start_date.isoformat())
+        if end_date:
+            query = query.lte("date", end_date.isoformat())
+        if categories:
+            query = query.in_("category", categories)
+        return query
+
+    def sync_ledger(self) -> pd.DataFrame:
+        """Bring the local copy of the ledger up to date, fetching only changed rows
+        when a valid cursor exists and falling back to a full reload otherwise"""
+        with self._sync_lock:
+            return self._sync_ledger()
+
+    def _sync_ledger(self) -> pd.DataFrame:
+        if not self.incremental_sync or self._ledger is None or self._cursor is None:
+            return self._reload_ledger()
+        since = (self._cursor - SYNC_OVERLAP).isoformat()
+        try:
+            changed = pd.DataFrame(
+                self._scoped(self.client.rpc("get_expenses_with_categories"))
+                .gt("updated_at", since)
+                .execute()
+                .data
+            )
+            deleted = pd.DataFrame(
+                self._scoped(
+                    self.client.table("expenses_tombstones").select("id,deleted_at")
+                )
+                .gt("deleted_at", since)
+                .execute()
+                .data
+            )
+        except (APIError, httpx.HTTPError):
+            return self._reload_ledger()
+        if not changed.empty and set(changed.columns) != set(self._ledger.columns):
+            return self._reload_ledger()
+
+        ledger = self._ledger.set_index("id")
+        if not deleted.empty:
+            ledger = ledger.drop(index=deleted["id"], errors="ignore")
+        if not changed.empty:
+            changed = changed[self._ledger.columns].set_index("id")
+            ledger = pd.concat([ledger.drop(index=changed.index, errors="ignore"), changed])
+        self._ledger = ledger.reset_index()[self._ledger.columns]
+        self._advance_cursor(changed.get("updated_at"), deleted.get("deleted_at"))
+        return self._ledger
+
+    def _reload_ledger(self) -> pd.DataFrame:
+        response: APIResponse = self._scoped(
+            self.client.rpc("get_expenses_with_categories")
+        ).execute()
+        self.restore_ledger(pd.DataFrame(response.data))
+        return self._ledger
+
+    def restore_ledger(self, ledger: pd.DataFrame) -> None:
+        """Use a ledger fetched earlier as the base for the next delta sync"""
+        self._ledger = ledger
+        self._cursor = None
+        if "updated_at" in ledger.columns:
+            self._advance_cursor(ledger["updated_at"])
+
+    def _scoped(self, query):
+        """Restrict a query to this client's account, if it has one"""
+        if self.user_id is None:
+            return query
+        return query.eq("user_id", self.user_id)
+
+    def _visible_categories(self, query):
+        """Restrict a categories query to the shared ones and the account's"""
+        if self.user_id is None:
+            return query
+        return query.or_(f"user_id.is.null,user_id.eq.{self.user_id}")
+
+    def _advance_cursor(self, *timestamps: pd.Series | None) -> None:
+        for values in timestamps:
+            if values is None or values.empty:
+                continue
+            latest = pd.to_datetime(values, utc=True, errors="coerce").max()
+            if pd.isna(latest):
+                # Unparseable timestamps, the next sync starts from scratch
+                self._cursor = None
+                return
+            if self._cursor is None or latest > self._cursor:
+                self._cursor = latest
+
+
+def _record_request(request: httpx.Request) -> None:
+    request.extensions["started"] = time.perf_counter()
+    metrics.count("supabase.requests")
+    metrics.count("supabase.request_bytes", len(request.content))
+
+
+def _record_response(response: httpx.Response) -> None:
+    # The caller reads the whole body next anyway, reading it here includes
+    # the transfer in the timing and makes its size available
+    response.read()
+    metrics.count("supabase.response_bytes", len(response.content))
+    started = response.request.extensions.get("started")
+    if started is not None:
+        metrics.record_timing("supabase.request", time.perf_counter() - started)
+
+
+@cache
+def get_client(url: str, key: str) -> "Client":
+    from supabase import create_client
+
+    client = create_client(url, key)
+    client.postgrest.session.event_hooks = {
+        "request": [_record_request],
+        "response": [_record_response],
+    }
+    return client
+
+
+def create_storage(
+    backend: str = storage_backend,
+    user_id: int | None = None,
+    read_only: bool = False,
+    **kwargs,
+) -> StorageBackend:
+    """Build the storage backend named by STORAGE_BACKEND.
+
+    Processes that only read, like the report worker, pass read_only so they
+    don't open the write queue and replica files the web app owns."""
+    if backend == "supabase":
+        if user_id is None or read_only:
+            # Unscoped clients look up accounts, they don't serve a dashboard
+            kwargs.setdefault("write_queue_path", None)
+            kwargs.setdefault("replica_path", None)
+        else:
+            # Each account queues writes and keeps a replica of its own
+            if write_behind:
+                kwargs.setdefault("write_queue_path", f"{write_queue_path}.{user_id}")
+            if replica_path:
+                kwargs.setdefault("replica_path", os.path.join(replica_path, str(user_id)))
+        return SupabaseClient(user_id=user_id, **kwargs)
+    if backend == "sqlite":
+        kwargs.setdefault("ttl", cache_ttl)
+        return SQLiteClient(sqlite_path, user_id=user_id, **kwargs)
+    raise ValueError(f"Unknown storage backend {backend}")
+
+
+# The account whose data this script run works with, set once authenticated
+current_user: ContextVar[int | None] = ContextVar("current_user", default=None)
+_storages: OrderedDict[int | None, StorageBackend] = OrderedDict()
+_storages_lock = threading.Lock()
+
+
+def storage_for(user_id: int | None) -> StorageBackend:
+    """The storage scoped to an account, kept across reruns and sessions so
+    the account's cache survives them. Past max_storages accounts, the least
+    recently used one is closed and rebuilt on its next visit."""
+    evicted = []
+    with _storages_lock:
+        if user_id in _storages:
+            _storages.move_to_end(user_id)
+        else:
+            _storages[user_id] = create_storage(user_id=user_id)
+            while len(_storages) > max_storages:
+                evicted.append(_storages.popitem(last=False)[1])
+        storage = _storages[user_id]
+    for old in evicted:
+        old.close()
+    return storage
+
 
+def __getattr__(name: str):
+    # `supabase_client`, the unscoped storage for account lookups and
+    # single-user deployments, is built on first access rather than on import
+    if name == "supabase_client":
+        return storage_for(None)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
-supabase_client = SupabaseClient()
 
+def with_supabase_client(client: StorageBackend | None = None):
+    """Pass the given client, or the current account's, as first argument"""
 
-def with_supabase_client(client: SupabaseClient = supabase_client):
     def decorator(func: Callable[P, R]) -> Callable[P, R]:
         @wraps(func)
         def wrapper(*args: P.args, **kwargs: P.kwargs) -> R:
-            return partial(func, client)(*args, **kwargs)
+            storage = client or storage_for(current_user.get())
+            return partial(func, storage)(*args, **kwargs)
 
         return wrapper
 
@@ -0,0 +1,92 @@
+"""Spending trends over a wide series: one row per period, one column per
+category. Every computation works on all categories at once."""
+
+import pandas as pd
+
+# Resampling rules by granularity, weeks start on Monday
+FREQUENCIES = {"W": "W-MON", "M": "MS"}
+PERIODS_PER_YEAR = {"W": 52, "M": 12}
+# Full months of history the month-end forecast is based on
+FORECAST_LOOKBACK_MONTHS = 3
+# Cap on how far a fast start to the month scales the rest of it up
+MAX_PACE = 2.0
+
+
+def spending_series(daily: pd.DataFrame) -> pd.DataFrame:
+    """Pivot daily totals (date, category, amount) into one row per day,
+    days without spending included as zeros"""
+    if daily.empty:
+        return pd.DataFrame(index=pd.DatetimeIndex([], name="date"), dtype="float64")
+    series = daily.assign(date=pd.to_datetime(daily["date"])).pivot_table(
+        index="date", columns="category", values="amount", aggfunc="sum", fill_value=0
+    )
+    series.columns = series.columns.astype(str)
+    return series.asfreq("D", fill_value=0).astype("float64")
+
+
+def resample_spending(daily: pd.DataFrame, freq: str) -> pd.DataFrame:
+    """Sum a spending_series per week ("W") or month ("M"), each labelled by
+    its first day"""
+    rule = FREQUENCIES[freq]
+    if freq == "W":
+        return daily.resample(rule, label="left", closed="left").sum()
+    return daily.resample(rule).sum()
+
+
+def rolling_average(series: pd.DataFrame, window: int) -> pd.DataFrame:
+    return series.rolling(window, min_periods=1).mean()
+
+
+def year_over_year(series: pd.DataFrame, freq: str) -> pd.DataFrame:
+    """Each period's total next to the same period a year earlier, a week
+    being compared with the one 52 weeks before"""
+    total = series.sum(axis=1)
+    previous = total.shift(PERIODS_PER_YEAR[freq])
+    return pd.DataFrame(
+        {
+            "current": total,
+            "previous": previous,
+            "change": (total - previous) / previous.where(previous != 0),
+        }
+    )
+
+
+def forecast_month_end(
+    daily: pd.DataFrame,
+    today: pd.Timestamp,
+    lookback: int = FORECAST_LOOKBACK_MONTHS,
+) -> pd.DataFrame:
+    """Projected spending per category by the end of today's month.
+
+    The days left are projected from what the previous `lookback` months
+    spent after the same day of the month, scaled by how this month's
+    spending so far compares with theirs by that day. A rent paid on the
+    1st thus adds nothing later in the month, while groceries running
+    above usual are projected to keep doing so. Categories without history
+    are projected at this month's daily rate."""
+    today = today.normalize()
+    month_start = today.replace(day=1)
+    days_left = today.days_in_month - today.day
+    history_start = month_start - pd.DateOffset(months=lookback)
+    # Extend to today, the ledger may have been quiet since its last entry
+    daily = daily.reindex(pd.date_range(history_start, today), fill_value=0)
+
+    month_to_date = daily.loc[month_start:].sum()
+    history = daily.loc[: month_start - pd.Timedelta(days=1)]
+    day = history.index.day
+    usual_to_date = history[day <= today.day].sum() / lookback
+    # Days this month doesn't have, like the 31st in February, don't count
+    rest = (day > today.day) & (day <= today.days_in_month)
+    usual_rest = history[rest].sum() / lookback
+    pace = (month_to_date / usual_to_date).where(usual_to_date > 0, 1.0)
+    remaining = usual_rest * pace.clip(upper=MAX_PACE)
+    new = (usual_to_date == 0) & (usual_rest == 0)
+    remaining = remaining.where(~new, month_to_date / today.day * days_left)
+    last_month = history.loc[month_start - pd.DateOffset(months=1) :].sum()
+    return pd.DataFrame(
+        {
+            "month_to_date": month_to_date,
+            "forecast": month_to_date + remaining,
+            "last_month": last_month,
+        }
+    ).rename_axis("category")
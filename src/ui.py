@@ -1,13 +1,34 @@
-from datetime import datetime, timedelta
+import os
+from datetime import date, datetime, timedelta
 
+import httpx
 import pandas as pd
-import plotly.express as px
 import streamlit as st
+from postgrest.exceptions import APIError
 
-from supabase_client import SupabaseClient, with_supabase_client
+import metrics
+from export import (
+    EXPORT_FORMATS,
+    export_entries,
+    export_file_name,
+    temporary_export_path,
+)
+from metrics import timed
+from storage import StorageBackend
+from supabase_client import with_supabase_client
+from trends import PERIODS_PER_YEAR, rolling_average, year_over_year
+from utils import normalize_categories
 
 
-def filter_by_date_range(expenses: pd.DataFrame):
+PAGE_SIZES = [25, 50, 100, 250]
+GRANULARITIES = {"Weekly": "W", "Monthly": "M"}
+# Rolling windows start at about a quarter
+ROLLING_WINDOWS = {"W": 13, "M": 3}
+# Categories charted until the user picks some
+TOP_CATEGORIES = 5
+
+
+def filter_by_date_range() -> tuple[date | None, date | None]:
     date_filter = st.selectbox(
         "Date Range",
         [
@@ -21,28 +42,20 @@ def filter_by_date_range(expenses: pd.DataFrame):
     if date_filter == "Custom Range":
         start_date = st.date_input("Start Date")
         end_date = st.date_input("End Date")
-        expenses = expenses[
-            (expenses["date"].dt.date >= start_date)
-            & (expenses["date"].dt.date <= end_date)
-        ]
+        return start_date, end_date
     elif date_filter != "All Time":
         days = {"Last 7 Days": 7, "Last 30 Days": 30, "Last 90 Days": 90}
-        cutoff_date = (datetime.now() - timedelta(days=days[date_filter])).strftime(
-            "%Y-%m-%d"
-        )
-        expenses = expenses[expenses["date"] >= cutoff_date]
-    return expenses
+        cutoff_date = (datetime.now() - timedelta(days=days[date_filter])).date()
+        return cutoff_date, None
+    return None, None
 
 
-def filter_by_category(expenses: pd.DataFrame, categories: list[str]):
+def filter_by_category(categories: list[str]) -> list[str]:
     with st.container():
-        selected_categories = st.multiselect("Categories", categories, default=None)
-        if selected_categories:
-            expenses = expenses[expenses["category"].isin(selected_categories)]
-        return expenses
+        return st.multiselect("Categories", categories, default=None)
 
 
-def sort_expenses_by(expenses: pd.DataFrame):
+def sort_expenses_by() -> tuple[str, bool]:
     col1, col2 = st.columns(2)
     with col1:
         sort_column = st.selectbox(
@@ -60,103 +73,316 @@ def sort_expenses_by(expenses: pd.DataFrame):
         sort_order = st.radio(
             "Sort order:", ("Descending", "Ascending"), horizontal=True
         )
-    ascending = sort_order == "Ascending"
-    if sort_column == "amount":
-        expenses = expenses.sort_values("amount", ascending=ascending)
-    elif sort_column == "date":
-        expenses = expenses.sort_values("date", ascending=ascending)
-    else:
-        expenses = expenses.sort_values(sort_column, ascending=ascending)
-    return expenses
+    return sort_column, sort_order == "Ascending"
+
+
+@timed("ui.filter_expenses")
+def filter_expenses(categories: list[str]) -> dict:
+    """Collect the filters as query arguments for SupabaseClient.query_entries"""
+    col1, col2 = st.columns(2)
+    with col1:
+        start_date, end_date = filter_by_date_range()
+    with col2:
+        selected_categories = filter_by_category(categories)
+    order_by, ascending = sort_expenses_by()
+    return {
+        "start_date": start_date,
+        "end_date": end_date,
+        "categories": tuple(selected_categories),
+        "order_by": order_by,
+        "ascending": ascending,
+    }
 
 
-def filter_expenses(expenses: pd.DataFrame, categories: list[str]) -> pd.DataFrame:
+def paginate() -> tuple[int, int]:
     col1, col2 = st.columns(2)
     with col1:
-        expenses = filter_by_date_range(expenses)
+        page_size = st.selectbox("Rows per page", PAGE_SIZES, index=1)
     with col2:
-        expenses = filter_by_category(expenses, categories)
-    expenses = sort_expenses_by(expenses)
-    return expenses
+        page = st.number_input("Page", min_value=1, step=1)
+    return int(page) - 1, page_size
 
 
+@timed("ui.make_expenses_table")
 @with_supabase_client()
-def make_expenses_table(client: SupabaseClient, expenses: pd.DataFrame):
-    def _center_align_row_html(row) -> str:
-        style = "margin-top: 5px; width: 100%;"
-        return f"<div style='{style}'>{row}</div>"
-
-    categories = list(expenses["category"].unique())
-    expenses = filter_expenses(expenses, categories)
-
-    expenses["date"] = expenses["date"].dt.date
-    for _, row in expenses.iterrows():
-        col1, col2, col3, col4, col5 = st.columns([2, 2, 2, 1, 1])
-        with col1:
-            st.markdown(_center_align_row_html(row["title"]), unsafe_allow_html=True)
-        with col2:
-            st.markdown(_center_align_row_html(row["category"]), unsafe_allow_html=True)
-        with col3:
-            st.markdown(_center_align_row_html(row["date"]), unsafe_allow_html=True)
-        with col4:
-            st.markdown(
-                _center_align_row_html(row["formatted_amount"]), unsafe_allow_html=True
-            )
-        with col5:
-            if st.button("🗑️", key=f"delete_{row['id']}", help="Delete this entry"):
-                response = client.delete_entry(row["id"])
-                if response.data:
-                    st.rerun()
-                else:
-                    st.error(f"Entry #{str(row['id'])} could not be deleted.")
-    return expenses
-
-
-def make_report(incomes: pd.DataFrame, expenses: pd.DataFrame):
-    if not expenses.empty:
-        incomes.loc[:, "date"] = pd.to_datetime(incomes["date"], format="%Y-%m-%d")
-        expenses.loc[:, "date"] = pd.to_datetime(expenses["date"], format="%Y-%m-%d")
-        current_month = datetime.now().replace(day=1).strftime("%Y-%d-%m")
-        current_month = pd.to_datetime(current_month, format="%Y-%d-%m")
-        stats = calculate_stats(incomes, expenses, current_month)
+def make_expenses_table(client: StorageBackend, categories: pd.DataFrame):
+    filters = filter_expenses(categories["name"].to_list())
+    page, page_size = paginate()
+    expenses, total = client.query_entries(
+        type="Expense", page=page, page_size=page_size, **filters
+    )
+    last_page = max((total - 1) // page_size, 0)
+    if page > last_page:
+        page = last_page
+        expenses, total = client.query_entries(
+            type="Expense", page=page, page_size=page_size, **filters
+        )
+    st.caption(f"Page {page + 1} of {last_page + 1} ({total} entries)")
+
+    editable = ["title", "category", "date", "amount"]
+    table = expenses[["id", *editable]].assign(
+        category=expenses["category"].astype(object),
+        date=expenses["date"].dt.date,
+        delete=False,
+    )
+    edited = st.data_editor(
+        table,
+        hide_index=True,
+        use_container_width=True,
+        disabled=["id"],
+        column_order=[*editable, "delete"],
+        column_config={
+            "title": st.column_config.TextColumn("Title", required=True),
+            "category": st.column_config.SelectboxColumn(
+                "Category", options=categories["name"].to_list(), required=True
+            ),
+            "date": st.column_config.DateColumn(
+                "Date", format="YYYY/MM/DD", required=True
+            ),
+            "amount": st.column_config.NumberColumn(
+                "Amount", min_value=0.0, format="€%.2f", required=True
+            ),
+            "delete": st.column_config.CheckboxColumn("🗑️", help="Delete this entry"),
+        },
+        # Edits are tracked per row position, so they must not outlive the page
+        key=f"expenses_table_{page}_{page_size}_{hash(tuple(filters.items()))}",
+    )
+
+    to_delete = edited[edited["delete"]]
+    changed = edited[
+        ~edited["delete"] & (edited[editable] != table[editable]).any(axis=1)
+    ]
+    if not (to_delete.empty and changed.empty) and st.button(
+        f"Save changes ({len(changed)} edited, {len(to_delete)} deleted)"
+    ):
+        save_table_changes(client, changed, to_delete)
+    return filters
+
+
+def discard_export():
+    export = st.session_state.pop("export", None)
+    if export is not None and os.path.exists(export["path"]):
+        os.remove(export["path"])
+
+
+@timed("ui.make_export")
+@with_supabase_client()
+def make_export(client: StorageBackend, filters: dict):
+    """Export the filtered expenses or every entry. The file is written to
+    disk batch by batch, and offered for download on that run only: Streamlit
+    reads a download button's file into memory on every rerun it's rendered
+    in. The next rerun, the download's included, removes it."""
+    # Downloaded or passed over, either way it's of no more use
+    discard_export()
+    col1, col2 = st.columns(2)
+    with col1:
+        scope = st.radio("Entries", ["Filtered expenses", "Full ledger"])
+    with col2:
+        format = st.selectbox("Format", list(EXPORT_FORMATS))
+    query = {}
+    if scope == "Filtered expenses":
+        query = {
+            "type": "Expense",
+            "start_date": filters["start_date"],
+            "end_date": filters["end_date"],
+            "categories": filters["categories"],
+        }
+    if not st.button("Prepare export"):
+        return
+    _, total = client.query_entries(page_size=1, **query)
+    progress = st.progress(0.0, text="Exporting...")
+    path = temporary_export_path(format)
+    st.session_state["export"] = {"path": path}
+    written = 0
+    try:
+        with metrics.timer("export.export_entries"):
+            for written in export_entries(client, path, format, **query):
+                progress.progress(
+                    min(written / max(total, 1), 1.0),
+                    text=f"Exported {written} of {total} entries",
+                )
+    except (APIError, httpx.HTTPError) as e:
+        discard_export()
+        progress.empty()
+        st.error(f"Exporting failed: {e}")
+        return
+    except BaseException:
+        # Stopped by a rerun, the partial file is of no use
+        discard_export()
+        raise
+    progress.empty()
+    if client.write_queue is not None and client.write_queue.pending():
+        st.warning("Changes not saved yet are missing from the export.")
+
+    _, mime = EXPORT_FORMATS[format]
+    with open(path, "rb") as file:
+        st.download_button(
+            f"Download {written} entries",
+            file,
+            file_name=export_file_name(format),
+            mime=mime,
+        )
+
+
+def save_table_changes(
+    client: StorageBackend,
+    changed: pd.DataFrame,
+    to_delete: pd.DataFrame,
+):
+    if not to_delete.empty:
+        response = client.delete_entries(to_delete["id"].astype(int).to_list())
+        if len(response.data) != len(to_delete):
+            st.error("Some entries could not be deleted.")
+            return
+    if not changed.empty:
+        entries = changed.assign(
+            type="Expense",
+            category=normalize_categories(changed["category"]).map(
+                client.category_index()
+            ),
+            date=pd.to_datetime(changed["date"]).dt.strftime("%Y-%m-%d"),
+        )[["id", "type", "title", "category", "amount", "date"]]
+        response = client.update_entries(entries.to_dict("records"))
+        if len(response.data) != len(entries):
+            st.error("Some entries could not be updated.")
+            return
+    st.rerun()
+
+
+@timed("ui.make_report")
+def make_report(rollup: pd.DataFrame):
+    if not rollup.empty:
+        current_month = pd.Period(datetime.now(), freq="M")
+        stats = calculate_stats(rollup, current_month)
         render_stats(stats)
 
         expenses_by_category = (
-            expenses[expenses["type"] == "Expense"]
-            .groupby("category")["amount"]
+            rollup[rollup["type"] == "Expense"]
+            .groupby("category", observed=True)["amount"]
             .sum()
             .reset_index()
         )
-        fig = px.bar(
-            expenses_by_category,
-            x="category",
-            y="amount",
-            title="Expenses by Category",
-        )
-        st.plotly_chart(fig)
+        with metrics.timer("ui.plotly_chart"):
+            # Imported here so everything above paints before plotly loads
+            import plotly.express as px
+
+            fig = px.bar(
+                expenses_by_category,
+                x="category",
+                y="amount",
+                title="Expenses by Category",
+            )
+            st.plotly_chart(fig)
     else:
         st.info("No data available for reporting")
 
 
-def calculate_stats(incomes: pd.DataFrame, expenses: pd.DataFrame, current_month):
-    current_month_incomes = incomes[incomes["date"] >= current_month]
-    current_month_expenses = expenses[expenses["date"] >= current_month]
-    total_income = current_month_incomes["amount"].sum()
-    total_expenses = current_month_expenses["amount"].sum()
+@timed("ui.make_trends")
+@with_supabase_client()
+def make_trends(client: StorageBackend):
+    """Per-category spending over time from the cached spending series, the
+    widgets only slice and roll it"""
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        granularity = st.radio("Granularity", list(GRANULARITIES), horizontal=True)
+    freq = GRANULARITIES[granularity]
+    series = client.load_spending_series(freq)
+    if series.empty:
+        st.info("No expenses to chart yet.")
+        return
+    with col2:
+        selected = st.multiselect(
+            "Categories",
+            series.columns.to_list(),
+            default=series.sum().nlargest(TOP_CATEGORIES).index.to_list(),
+            key="trends_categories",
+        )
+    with col3:
+        window = st.slider(
+            "Rolling average (periods)",
+            min_value=1,
+            max_value=PERIODS_PER_YEAR[freq],
+            value=ROLLING_WINDOWS[freq],
+            key=f"trends_window_{freq}",
+        )
+    series = series[selected] if selected else series
 
-    prev_month = current_month - pd.DateOffset(months=1)
-    prev_month_incomes = incomes[
-        (incomes["date"] >= prev_month) & (incomes["date"] < current_month)
-    ]
-    prev_month_expenses = expenses[
-        (expenses["date"] >= prev_month) & (expenses["date"] < current_month)
-    ]
-    prev_income = prev_month_incomes[prev_month_incomes["type"] == "Income"][
-        "amount"
-    ].sum()
-    prev_expenses = prev_month_expenses[prev_month_expenses["type"] == "Expense"][
-        "amount"
-    ].sum()
+    forecast = client.load_month_end_forecast(date.today())
+    render_forecast(forecast, series.columns)
+
+    averages = rolling_average(series, window).melt(
+        ignore_index=False, var_name="category", value_name="amount"
+    )
+    yoy = (
+        year_over_year(series, freq)
+        .tail(PERIODS_PER_YEAR[freq])
+        .rename(columns={"current": "This year", "previous": "Last year"})
+        .melt(
+            value_vars=["This year", "Last year"],
+            ignore_index=False,
+            var_name="year",
+            value_name="amount",
+        )
+    )
+    with metrics.timer("ui.plotly_chart"):
+        import plotly.express as px
+
+        st.plotly_chart(
+            px.line(
+                averages.reset_index(),
+                x="date",
+                y="amount",
+                color="category",
+                title=f"{granularity} spending, {window}-period rolling average",
+            )
+        )
+        st.plotly_chart(
+            px.bar(
+                yoy.reset_index(),
+                x="date",
+                y="amount",
+                color="year",
+                barmode="group",
+                title="Year over year",
+            )
+        )
+
+
+def render_forecast(forecast: pd.DataFrame, categories: pd.Index):
+    total = forecast.sum()
+    col1, col2 = st.columns(2)
+    with col1:
+        st.metric("Spent this month", f"€{total['month_to_date']:.2f}")
+    with col2:
+        st.metric(
+            "Month-end forecast",
+            f"€{total['forecast']:.2f}",
+            f"€{total['forecast'] - total['last_month']:.2f} vs last month",
+            delta_color="inverse",
+        )
+    shown = forecast.reindex(categories).dropna()
+    st.dataframe(
+        shown[shown.any(axis=1)].sort_values("forecast", ascending=False),
+        use_container_width=True,
+        column_config={
+            "month_to_date": st.column_config.NumberColumn("So far", format="€%.2f"),
+            "forecast": st.column_config.NumberColumn("Forecast", format="€%.2f"),
+            "last_month": st.column_config.NumberColumn("Last month", format="€%.2f"),
+        },
+    )
+
+
+def calculate_stats(rollup: pd.DataFrame, current_month: pd.Period):
+    totals = rollup.groupby(["month", "type"], observed=True)["amount"].sum()
+
+    def _total(months: pd.Series, type: str) -> float:
+        return totals[months & (totals.index.get_level_values("type") == type)].sum()
+
+    month = totals.index.get_level_values("month")
+    total_income = _total(month >= current_month, "Income")
+    total_expenses = _total(month >= current_month, "Expense")
+    prev_income = _total(month == current_month - 1, "Income")
+    prev_expenses = _total(month == current_month - 1, "Expense")
     savings = total_income - total_expenses
     prev_savings = prev_income - prev_expenses
     return {
@@ -189,3 +415,22 @@ def render_stats(stats: dict):
             f"€{stats['savings']:.2f}",
             f"€{stats['prev_savings']:.2f}",
         )
+
+
+def render_debug_panel(trace: metrics.Trace):
+    """Latency breakdown of the rerun that just finished, and process totals"""
+    last = trace.to_dict()
+    timings = pd.DataFrame.from_dict(
+        last["timings"], orient="index", columns=["seconds", "calls"]
+    )
+    with st.sidebar.expander("Debug", expanded=False):
+        st.metric("Rerun", f"{trace.total * 1000:.0f} ms")
+        st.caption("This rerun, nested steps include their children")
+        st.dataframe(
+            timings.assign(ms=timings["seconds"] * 1000)
+            .sort_values("ms", ascending=False)[["ms", "calls"]],
+            use_container_width=True,
+        )
+        st.json(last["counters"], expanded=False)
+        st.caption("Since startup")
+        st.json(metrics.totals(), expanded=False)
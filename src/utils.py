@@ -1,23 +1,191 @@
 import base64
 import getpass
-import hashlib
 import secrets
+import uuid
 
 import pandas as pd
 
+from metrics import timed
+from passwords import hash_password
 
+ENTRY_TYPES = ["Expense", "Income"]
+ENTRY_COLUMNS = ["type", "title", "category", "amount", "date"]
+ROLLUP_COLUMNS = ["month", "type", "category", "amount"]
+# Loaded ledgers keep the idempotency keys until queued inserts have been
+# matched against them, see write_queue.apply_pending
+LEDGER_COLUMNS = ["type", "id", "title", "category", "amount", "date", "idempotency_key"]
+# Seeds for the two halves of imported entries' idempotency keys
+IMPORT_KEY_SEEDS = ("save-it-import-1", "save-it-import-2")
+# Low-cardinality labels as categoricals, titles as Arrow-backed strings;
+# amounts stay float64 since float32 cannot hold cents exactly past ~10^5
+EXPENSES_DTYPES = {
+    "type": pd.CategoricalDtype(ENTRY_TYPES),
+    "id": "int64",
+    "title": "string[pyarrow]",
+    "category": "category",
+    "amount": "float64",
+    "idempotency_key": "string[pyarrow]",
+}
+
+
+@timed("format_expenses_df")
 def format_expenses_df(
     data: pd.DataFrame,
     cols: list[str] = ["type", "id", "title", "category", "amount", "date"],
 ) -> pd.DataFrame:
-    formatted_data = data[cols]
-    formatted_data["date"] = pd.to_datetime(formatted_data["date"], format="%Y-%m-%d")
-    formatted_data["formatted_amount"] = formatted_data["amount"].apply(
-        lambda x: f"€{x:.2f}"
+    formatted_data = data.reindex(columns=cols).astype(
+        {col: dtype for col, dtype in EXPENSES_DTYPES.items() if col in cols}
     )
+    formatted_data["date"] = pd.to_datetime(formatted_data["date"], format="%Y-%m-%d")
     return formatted_data
 
 
+def build_rollup(data: pd.DataFrame) -> pd.DataFrame:
+    """Sum amounts per month, type and category in a single groupby pass"""
+    if data.empty:
+        return pd.DataFrame(columns=ROLLUP_COLUMNS)
+    month = data["date"].dt.to_period("M").rename("month")
+    return (
+        data.groupby([month, "type", "category"], observed=True)["amount"]
+        .sum()
+        .reset_index()
+    )
+
+
+def format_rollup_df(data: pd.DataFrame) -> pd.DataFrame:
+    """Type a rollup fetched from the get_monthly_totals RPC like build_rollup's"""
+    rollup = data.reindex(columns=ROLLUP_COLUMNS).astype(
+        {"type": EXPENSES_DTYPES["type"], "category": "category", "amount": "float64"}
+    )
+    rollup["month"] = pd.to_datetime(rollup["month"]).dt.to_period("M")
+    return rollup
+
+
+def normalize_category(name: str) -> str:
+    """Key a category name is looked up by, ignoring case and spacing"""
+    return " ".join(name.split()).casefold()
+
+
+def normalize_categories(names: pd.Series) -> pd.Series:
+    """normalize_category over a column, once per distinct name"""
+    names = names.astype(object)
+    keys = {name: normalize_category(name) for name in names.dropna().unique()}
+    return names.map(keys)
+
+
+def normalize_entries_df(
+    data: pd.DataFrame, category_ids: dict[str, int]
+) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """Validate and normalize raw entries in a single vectorized pass,
+    category_ids is keyed by normalize_category.
+
+    Returns the rows ready to be inserted and the rows that were rejected."""
+    missing = [col for col in ENTRY_COLUMNS if col not in data.columns]
+    if missing:
+        raise ValueError(f"Missing columns: {', '.join(missing)}")
+
+    entries = pd.DataFrame(
+        {
+            "type": data["type"].astype("string").str.strip().str.capitalize(),
+            "title": data["title"].astype("string").str.strip(),
+            "category": normalize_categories(data["category"]).map(category_ids),
+            "amount": pd.to_numeric(data["amount"], errors="coerce").round(2),
+            # Bank exports use YYYY/MM/DD, the API expects YYYY-MM-DD
+            "date": pd.to_datetime(
+                data["date"].astype("string").str.strip().str.replace("/", "-"),
+                format="%Y-%m-%d",
+                errors="coerce",
+            ),
+        },
+        index=data.index,
+    )
+    valid = (
+        entries["type"].isin(ENTRY_TYPES).fillna(False)
+        & entries["title"].fillna("").ne("")
+        & entries.notna().all(axis=1)
+    )
+    entries = entries[valid].astype({"category": "int64", "amount": "float64"})
+    entries["date"] = entries["date"].dt.strftime("%Y-%m-%d")
+    entries = entries.astype({"type": object, "title": object, "date": object})
+    return entries, data[~valid]
+
+
+def fingerprint_entries(entries: pd.DataFrame, with_category: bool = True) -> pd.Series:
+    """Hash of each entry's type, title, category id, amount and date, equal
+    for stored entries and their normalize_entries_df counterpart"""
+    key = pd.DataFrame(
+        {
+            "type": entries["type"].astype(str),
+            "title": entries["title"].astype(str).str.strip(),
+            "amount": entries["amount"].astype("float64").round(2),
+            "date": pd.to_datetime(entries["date"], format="%Y-%m-%d"),
+        },
+        index=entries.index,
+    )
+    if with_category:
+        key.insert(2, "category", entries["category"].astype("int64"))
+    return pd.util.hash_pandas_object(key, index=False)
+
+
+class FingerprintIndex:
+    """Stored entries counted by fingerprint, to skip rows an import already
+    added.
+
+    Each stored entry matches one identical imported row, so re-uploading
+    an overlapping export adds nothing, while a row that genuinely repeats,
+    like two identical coffees on one day, goes in once per occurrence.
+
+    Rows the file left without a category are matched on everything else,
+    since the category they were given is a guess that changes as the
+    ledger grows, or was corrected since."""
+
+    def __init__(self, stored: pd.DataFrame, scope: str = "") -> None:
+        self.stored = pd.concat(
+            [
+                fingerprint_entries(stored),
+                fingerprint_entries(stored, with_category=False),
+            ]
+        ).value_counts()
+        self.seen = pd.Series(dtype="int64")
+        self.scope = scope
+
+    def match(
+        self, entries: pd.DataFrame, uncategorized: pd.Series | None = None
+    ) -> tuple[pd.Series, pd.Series]:
+        """Whether each entry is already stored, and idempotency keys for the
+        others from their fingerprint and occurrence, so replaying an import
+        is a no-op. Call it with each chunk of an import in order.
+
+        `uncategorized` flags the entries whose category was filled in."""
+        fingerprints = fingerprint_entries(entries)
+        if uncategorized is not None and uncategorized.any():
+            fingerprints = fingerprints.where(
+                ~uncategorized, fingerprint_entries(entries, with_category=False)
+            )
+        occurrence = fingerprints.groupby(fingerprints).cumcount() + fingerprints.map(
+            self.seen
+        ).fillna(0).astype("int64")
+        self.seen = self.seen.add(fingerprints.value_counts(), fill_value=0)
+        duplicate = occurrence < fingerprints.map(self.stored).fillna(0)
+
+        new = pd.DataFrame(
+            {"scope": self.scope, "fingerprint": fingerprints, "occurrence": occurrence}
+        )[~duplicate]
+        high, low = (
+            pd.util.hash_pandas_object(new, index=False, hash_key=seed)
+            for seed in IMPORT_KEY_SEEDS
+        )
+        keys = pd.Series(
+            [
+                str(uuid.UUID(int=h << 64 | l))
+                for h, l in zip(high.tolist(), low.tolist())
+            ],
+            index=new.index,
+            dtype=object,
+        )
+        return duplicate, keys
+
+
 def generate_jwt_secret():
     # Generate a 32-byte (256-bit) random secret
     random_bytes = secrets.token_bytes(32)
@@ -30,7 +198,7 @@ def generate_jwt_secret():
 
 def generate_password_hash():
     password = getpass.getpass("Enter your password: ")
-    password_hash = hashlib.sha256(password.encode()).hexdigest()
+    password_hash = hash_password(password)
     print("\nYour password hash is:")
     print(password_hash)
     print("\nAdd this hash to your docker-compose.yml file as ADMIN_PASSWORD_HASH")
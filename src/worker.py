@@ -0,0 +1,116 @@
+"""Standalone process that emails scheduled reports.
+
+    python src/worker.py
+
+Runs in its own process (the `worker` service in docker-compose.yml) so
+report rendering and SMTP retries never block the Streamlit server.
+"""
+
+import logging
+import os
+import time
+from datetime import date, timedelta
+
+import schedule
+
+from report import EMAIL_ADDRESS, send_batch_reports
+from storage import StorageBackend
+from supabase_client import create_storage
+
+REPORT_TIME = os.environ.get("REPORT_TIME", "08:00")
+REPORT_RECIPIENTS = os.environ.get("REPORT_RECIPIENTS", EMAIL_ADDRESS or "").split(",")
+# Whose entries the reports cover
+REPORT_USER = os.environ.get("REPORT_USER", os.environ.get("ADMIN_USERNAME"))
+MAX_IDLE = 60
+
+logger = logging.getLogger(__name__)
+
+
+def previous_week(today: date) -> tuple[date, date]:
+    end_date = today - timedelta(days=1)
+    return end_date - timedelta(days=6), end_date
+
+
+def previous_month(today: date) -> tuple[date, date]:
+    end_date = today.replace(day=1) - timedelta(days=1)
+    return end_date.replace(day=1), end_date
+
+
+_client: StorageBackend | None = None
+
+
+def report_storage() -> StorageBackend | None:
+    """The storage scoped to REPORT_USER, None while that account doesn't
+    exist. The account is created on the admin's first login, so it is
+    looked up again on every run until then."""
+    global _client
+    if _client is None:
+        user = create_storage().load_user(REPORT_USER)
+        if user is not None:
+            _client = create_storage(user_id=user["id"], read_only=True)
+    return _client
+
+
+def run_report(period: str, start_date: date, end_date: date):
+    try:
+        client = report_storage()
+    except Exception:
+        logger.exception("Looking up account %s failed", REPORT_USER)
+        return
+    if client is None:
+        # Never fall back to unscoped storage, it holds every account's entries
+        logger.error("No account named %s, skipping the %s report", REPORT_USER, period)
+        return
+    logger.info("Sending %s report for %s to %s", period, start_date, end_date)
+    jobs = [
+        {
+            "recipient": recipient.strip(),
+            "period": period,
+            "start_date": start_date,
+            "end_date": end_date,
+        }
+        for recipient in REPORT_RECIPIENTS
+        if recipient.strip()
+    ]
+    try:
+        statuses = send_batch_reports(client, jobs)
+    except Exception:
+        # Keep the worker alive, the next scheduled run will try again
+        logger.exception("%s report failed", period)
+        return
+    for status in statuses:
+        if status["error"]:
+            logger.error(
+                "%s report to %s failed: %s",
+                period,
+                status["recipient"],
+                status["error"],
+            )
+
+
+def weekly_report():
+    run_report("Weekly", *previous_week(date.today()))
+
+
+def monthly_report():
+    # schedule has no monthly interval, so this runs daily and checks the date
+    if date.today().day == 1:
+        run_report("Monthly", *previous_month(date.today()))
+
+
+def main():
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s %(message)s"
+    )
+    if not REPORT_USER:
+        raise SystemExit("Set REPORT_USER or ADMIN_USERNAME to the account to report on")
+    schedule.every().sunday.at(REPORT_TIME).do(weekly_report)
+    schedule.every().day.at(REPORT_TIME).do(monthly_report)
+    logger.info("Report worker started, next run at %s", schedule.next_run())
+    while True:
+        schedule.run_pending()
+        time.sleep(min(max(schedule.idle_seconds() or 0, 1), MAX_IDLE))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,274 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import uuid
+from contextlib import closing
+from typing import TYPE_CHECKING
+
+import httpx
+import pandas as pd
+from postgrest.base_request_builder import APIResponse
+from postgrest.exceptions import APIError
+
+from utils import EXPENSES_DTYPES, build_rollup
+
+if TYPE_CHECKING:
+    from storage import StorageBackend
+
+FLUSH_BATCH_SIZE = 100
+FLUSH_INTERVAL = 2.0  # seconds
+MAX_BACKOFF = 60.0
+# Rejected by the server this many times and the mutation is set aside
+MAX_ATTEMPTS = 5
+
+logger = logging.getLogger(__name__)
+
+# Shared by the queues on a file. An evicted account's queue flushes once more
+# on its way out, and must not overlap the flushes of the one that replaces it
+_flush_locks: dict[str, threading.Lock] = {}
+_flush_locks_lock = threading.Lock()
+
+
+def flush_lock(path: str) -> threading.Lock:
+    with _flush_locks_lock:
+        return _flush_locks.setdefault(os.path.abspath(path), threading.Lock())
+
+
+class WriteBehindQueue:
+    """Durable queue of entry mutations, flushed to Supabase in batches by a
+    background thread.
+
+    Mutations are stored in SQLite before returning, so they survive restarts
+    and network outages. Inserts carry an idempotency key, so replaying a
+    batch that was applied but not yet removed from the queue is harmless."""
+
+    def __init__(
+        self,
+        client: "StorageBackend",
+        path: str,
+        batch_size: int = FLUSH_BATCH_SIZE,
+        interval: float = FLUSH_INTERVAL,
+    ) -> None:
+        self.client = client
+        self.path = path
+        self.batch_size = batch_size
+        self.interval = interval
+        self._flush_lock = flush_lock(path)
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+        with closing(self._connect()) as db, db:
+            db.execute(
+                """
+                create table if not exists mutations (
+                    seq integer primary key autoincrement,
+                    key text unique not null,
+                    op text not null,
+                    payload text not null,
+                    attempts integer not null default 0,
+                    last_error text,
+                    failed integer not null default 0
+                )
+                """
+            )
+
+    def _connect(self) -> sqlite3.Connection:
+        db = sqlite3.connect(self.path, timeout=30)
+        db.execute("pragma journal_mode=wal")
+        return db
+
+    def enqueue(self, op: str, payloads: list[dict]) -> APIResponse:
+        """Persist mutations and return a response shaped like the API's"""
+        keys = [str(uuid.uuid4()) for _ in payloads]
+        if op == "insert":
+            payloads = [
+                {**payload, "idempotency_key": key}
+                for payload, key in zip(payloads, keys)
+            ]
+        with closing(self._connect()) as db, db:
+            db.executemany(
+                "insert into mutations (key, op, payload) values (?, ?, ?)",
+                [(key, op, json.dumps(p)) for key, p in zip(keys, payloads)],
+            )
+        self._wake.set()
+        return APIResponse(data=payloads, count=None)
+
+    def pending(self) -> list[tuple[str, dict]]:
+        with closing(self._connect()) as db:
+            rows = db.execute(
+                "select op, payload from mutations where not failed order by seq"
+            ).fetchall()
+        return [(op, json.loads(payload)) for op, payload in rows]
+
+    def failed(self) -> list[dict]:
+        """Mutations set aside after MAX_ATTEMPTS, with the last error"""
+        with closing(self._connect()) as db:
+            rows = db.execute(
+                "select op, payload, last_error from mutations where failed "
+                "order by seq"
+            ).fetchall()
+        return [
+            {"op": op, "payload": json.loads(payload), "error": error}
+            for op, payload, error in rows
+        ]
+
+    def discard_failed(self) -> int:
+        with closing(self._connect()) as db, db:
+            return db.execute("delete from mutations where failed").rowcount
+
+    def flush(self) -> int:
+        """Apply queued mutations in order, batching runs of the same operation.
+
+        Returns how many were applied. Stops at the first failure so that
+        later mutations are never applied before earlier ones."""
+        with self._flush_lock, closing(self._connect()) as db:
+            rows = db.execute(
+                "select seq, op, payload, attempts from mutations "
+                "where not failed order by seq limit ?",
+                (self.batch_size,),
+            ).fetchall()
+            flushed = 0
+            for op, batch in _runs(rows):
+                self._apply(db, op, batch)
+                flushed += len(batch)
+            return flushed
+
+    def _apply(self, db: sqlite3.Connection, op: str, batch: list[tuple]):
+        """Apply a run of mutations and remove them from the queue.
+
+        A rejected run is retried one mutation at a time, so only the one
+        the server rejects is charged the attempt and, after MAX_ATTEMPTS,
+        set aside, not the valid ones batched with it."""
+        seqs = [seq for seq, *_ in batch]
+        payloads = [json.loads(payload) for _, _, payload, _ in batch]
+        try:
+            self.client.apply_mutations(op, payloads)
+        except APIError as e:
+            if len(batch) > 1:
+                for row in batch:
+                    self._apply(db, op, [row])
+                return
+            # Network errors propagate without counting as attempts
+            with db:
+                db.execute(
+                    "update mutations set attempts = attempts + 1, "
+                    "last_error = ?, failed = attempts + 1 >= ? where seq = ?",
+                    (str(e), MAX_ATTEMPTS, seqs[0]),
+                )
+            raise
+        with db:
+            db.executemany(
+                "delete from mutations where seq = ?", [(seq,) for seq in seqs]
+            )
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._run, name="write-behind", daemon=True
+            )
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+    def _run(self):
+        delay = self.interval
+        while not self._stop.is_set():
+            self._wake.wait(delay)
+            self._wake.clear()
+            try:
+                while self.flush() == self.batch_size:
+                    pass
+                delay = self.interval
+            except (APIError, httpx.HTTPError) as e:
+                delay = min(delay * 2, MAX_BACKOFF)
+                logger.warning(
+                    "Flushing writes failed (%s), retrying in %ss", e, delay
+                )
+            except Exception:
+                # Anything else, like a locked queue database, must not end
+                # the thread or nothing is flushed until a restart
+                delay = min(delay * 2, MAX_BACKOFF)
+                logger.exception("Flushing writes failed, retrying in %ss", delay)
+
+
+def _runs(rows: list[tuple]) -> list[tuple[str, list[tuple]]]:
+    """Group consecutive rows with the same operation"""
+    runs = []
+    for row in rows:
+        if runs and runs[-1][0] == row[1]:
+            runs[-1][1].append(row)
+        else:
+            runs.append((row[1], [row]))
+    return runs
+
+
+def apply_pending(
+    data: pd.DataFrame,
+    pending: list[tuple[str, dict]],
+    category_names: dict[int, str],
+    with_inserts: bool = False,
+) -> pd.DataFrame:
+    """Show queued mutations on top of a formatted expenses frame"""
+    if not pending:
+        return data
+    data = data.astype({"type": object, "category": object}).set_index("id")
+    inserted = []
+    for op, payload in pending:
+        if op == "delete":
+            data = data.drop(index=payload["id"], errors="ignore")
+            continue
+        values = payload.get("values", payload)
+        values = {k: v for k, v in values.items() if k in data.columns}
+        if "category" in values:
+            values["category"] = category_names.get(values["category"])
+        if "date" in values:
+            values["date"] = pd.Timestamp(values["date"])
+        if op == "insert":
+            inserted.append(values)
+        elif payload["id"] in data.index:
+            for column, value in values.items():
+                data.loc[payload["id"], column] = value
+    data = data.reset_index()
+    if with_inserts and inserted and "idempotency_key" in data:
+        # Flushed but not removed from the queue yet, they're stored already
+        keys = [values.get("idempotency_key") for values in inserted]
+        stored = set(data.loc[data["idempotency_key"].isin(keys), "idempotency_key"])
+        inserted = [
+            values for values in inserted if values.get("idempotency_key") not in stored
+        ]
+    if with_inserts and inserted:
+        # Not saved yet, so they have no id, use negative placeholders instead
+        placeholders = pd.DataFrame(inserted).assign(
+            id=range(-1, -len(inserted) - 1, -1)
+        )
+        data = pd.concat([data, placeholders], ignore_index=True)
+    return data
+
+
+def add_pending_inserts(
+    rollup: pd.DataFrame,
+    pending: list[tuple[str, dict]],
+    category_names: dict[int, str],
+) -> pd.DataFrame:
+    """Add queued inserts to monthly totals, see utils.build_rollup. Queued
+    edits and deletes are left out, the totals don't say what the entries
+    were before."""
+    inserted = pd.DataFrame([payload for op, payload in pending if op == "insert"])
+    if inserted.empty:
+        return rollup
+    inserted = inserted.assign(
+        category=inserted["category"].map(category_names),
+        date=pd.to_datetime(inserted["date"]),
+    )
+    return (
+        pd.concat([rollup, build_rollup(inserted)])
+        .groupby(["month", "type", "category"], observed=True, as_index=False)[
+            "amount"
+        ]
+        .sum()
+        .astype({"type": EXPENSES_DTYPES["type"], "category": "category"})
+    )
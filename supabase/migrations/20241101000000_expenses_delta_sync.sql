@@ -0,0 +1,67 @@
+-- Track row changes on expenses so clients can sync incrementally.
+
+alter table expenses
+    add column if not exists updated_at timestamptz not null default now();
+
+create index if not exists expenses_updated_at_idx on expenses (updated_at);
+
+create or replace function touch_updated_at()
+returns trigger
+language plpgsql
+as $$
+begin
+    new.updated_at := now();
+    return new;
+end;
+$$;
+
+drop trigger if exists expenses_touch_updated_at on expenses;
+create trigger expenses_touch_updated_at
+    before update on expenses
+    for each row execute function touch_updated_at();
+
+-- Deleted rows leave a tombstone behind so deletes can be synced as well.
+create table if not exists expenses_tombstones (
+    id bigint primary key,
+    deleted_at timestamptz not null default now()
+);
+
+create index if not exists expenses_tombstones_deleted_at_idx
+    on expenses_tombstones (deleted_at);
+
+create or replace function record_expense_tombstone()
+returns trigger
+language plpgsql
+as $$
+begin
+    insert into expenses_tombstones (id, deleted_at)
+    values (old.id, now())
+    on conflict (id) do update set deleted_at = excluded.deleted_at;
+    return old;
+end;
+$$;
+
+drop trigger if exists expenses_record_tombstone on expenses;
+create trigger expenses_record_tombstone
+    after delete on expenses
+    for each row execute function record_expense_tombstone();
+
+-- Expose updated_at through the RPC used by SupabaseClient.load_data.
+drop function if exists get_expenses_with_categories();
+create function get_expenses_with_categories()
+returns table (
+    id bigint,
+    type text,
+    title text,
+    category text,
+    amount numeric,
+    date date,
+    updated_at timestamptz
+)
+language sql
+stable
+as $$
+    select e.id, e.type, e.title, c.name as category, e.amount, e.date, e.updated_at
+    from expenses e
+    join categories c on c.id = e.category;
+$$;
@@ -0,0 +1,74 @@
+-- Aggregations for the dashboard, so reports transfer a few rows per month
+-- instead of the whole ledger. Null bounds mean an open-ended range.
+
+create index if not exists expenses_date_idx on expenses (date);
+
+create or replace function get_monthly_totals(
+    start_date date default null,
+    end_date date default null
+)
+returns table (
+    month date,
+    type text,
+    category text,
+    amount numeric
+)
+language sql
+stable
+as $$
+    select date_trunc('month', e.date)::date as month, e.type, c.name, sum(e.amount)
+    from expenses e
+    join categories c on c.id = e.category
+    where (start_date is null or e.date >= start_date)
+      and (end_date is null or e.date <= end_date)
+    group by 1, 2, 3
+    order by 1, 2, 3;
+$$;
+
+create or replace function get_category_totals(
+    start_date date default null,
+    end_date date default null,
+    entry_type text default 'Expense'
+)
+returns table (
+    category text,
+    amount numeric
+)
+language sql
+stable
+as $$
+    select c.name, sum(e.amount)
+    from expenses e
+    join categories c on c.id = e.category
+    where e.type = entry_type
+      and (start_date is null or e.date >= start_date)
+      and (end_date is null or e.date <= end_date)
+    group by 1
+    order by 2 desc;
+$$;
+
+create or replace function get_savings_series(
+    start_date date default null,
+    end_date date default null
+)
+returns table (
+    month date,
+    income numeric,
+    expenses numeric,
+    savings numeric
+)
+language sql
+stable
+as $$
+    select
+        date_trunc('month', e.date)::date as month,
+        coalesce(sum(e.amount) filter (where e.type = 'Income'), 0),
+        coalesce(sum(e.amount) filter (where e.type = 'Expense'), 0),
+        coalesce(sum(e.amount) filter (where e.type = 'Income'), 0)
+            - coalesce(sum(e.amount) filter (where e.type = 'Expense'), 0)
+    from expenses e
+    where (start_date is null or e.date >= start_date)
+      and (end_date is null or e.date <= end_date)
+    group by 1
+    order by 1;
+$$;
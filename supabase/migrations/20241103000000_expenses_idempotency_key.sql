@@ -0,0 +1,4 @@
+-- Lets queued inserts be replayed safely, see src/write_queue.py.
+
+alter table expenses
+    add column if not exists idempotency_key uuid unique;
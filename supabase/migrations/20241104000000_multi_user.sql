@@ -0,0 +1,149 @@
+-- Accounts, and expenses partitioned by the account that owns them.
+-- Categories stay shared between accounts.
+
+create table if not exists users (
+    id bigint generated by default as identity primary key,
+    username text unique not null,
+    password_hash text not null,
+    is_admin boolean not null default false,
+    created_at timestamptz not null default now()
+);
+
+-- Password hashes must never be readable through PostgREST with the anon
+-- key. With RLS on and no policies only the service role, which bypasses
+-- RLS, can reach the table, so the app's SUPABASE_KEY is the service key.
+alter table users enable row level security;
+revoke all on table users from anon, authenticated;
+
+-- Entries from before accounts existed have no owner, the admin claims them
+-- on login, see SupabaseClient.ensure_admin.
+alter table expenses
+    add column if not exists user_id bigint references users (id);
+
+-- Every read filters on user_id first
+create index if not exists expenses_user_id_date_idx on expenses (user_id, date);
+create index if not exists expenses_user_id_updated_at_idx
+    on expenses (user_id, updated_at);
+
+alter table expenses_tombstones
+    add column if not exists user_id bigint;
+
+create index if not exists expenses_tombstones_user_id_deleted_at_idx
+    on expenses_tombstones (user_id, deleted_at);
+
+create or replace function record_expense_tombstone()
+returns trigger
+language plpgsql
+as $$
+begin
+    insert into expenses_tombstones (id, user_id, deleted_at)
+    values (old.id, old.user_id, now())
+    on conflict (id) do update
+        set user_id = excluded.user_id, deleted_at = excluded.deleted_at;
+    return old;
+end;
+$$;
+
+-- Expose user_id so callers can filter on it. The function is plain SQL, so
+-- Postgres inlines it and the filter reaches the index.
+drop function if exists get_expenses_with_categories();
+create function get_expenses_with_categories()
+returns table (
+    id bigint,
+    type text,
+    title text,
+    category text,
+    amount numeric,
+    date date,
+    updated_at timestamptz,
+    user_id bigint
+)
+language sql
+stable
+as $$
+    select e.id, e.type, e.title, c.name as category, e.amount, e.date,
+        e.updated_at, e.user_id
+    from expenses e
+    join categories c on c.id = e.category;
+$$;
+
+-- The aggregates filter before grouping, so they take the account as an
+-- argument. A null for_user aggregates every account.
+drop function if exists get_monthly_totals(date, date);
+create function get_monthly_totals(
+    start_date date default null,
+    end_date date default null,
+    for_user bigint default null
+)
+returns table (
+    month date,
+    type text,
+    category text,
+    amount numeric
+)
+language sql
+stable
+as $$
+    select date_trunc('month', e.date)::date as month, e.type, c.name, sum(e.amount)
+    from expenses e
+    join categories c on c.id = e.category
+    where (for_user is null or e.user_id = for_user)
+      and (start_date is null or e.date >= start_date)
+      and (end_date is null or e.date <= end_date)
+    group by 1, 2, 3
+    order by 1, 2, 3;
+$$;
+
+drop function if exists get_category_totals(date, date, text);
+create function get_category_totals(
+    start_date date default null,
+    end_date date default null,
+    entry_type text default 'Expense',
+    for_user bigint default null
+)
+returns table (
+    category text,
+    amount numeric
+)
+language sql
+stable
+as $$
+    select c.name, sum(e.amount)
+    from expenses e
+    join categories c on c.id = e.category
+    where e.type = entry_type
+      and (for_user is null or e.user_id = for_user)
+      and (start_date is null or e.date >= start_date)
+      and (end_date is null or e.date <= end_date)
+    group by 1
+    order by 2 desc;
+$$;
+
+drop function if exists get_savings_series(date, date);
+create function get_savings_series(
+    start_date date default null,
+    end_date date default null,
+    for_user bigint default null
+)
+returns table (
+    month date,
+    income numeric,
+    expenses numeric,
+    savings numeric
+)
+language sql
+stable
+as $$
+    select
+        date_trunc('month', e.date)::date as month,
+        coalesce(sum(e.amount) filter (where e.type = 'Income'), 0),
+        coalesce(sum(e.amount) filter (where e.type = 'Expense'), 0),
+        coalesce(sum(e.amount) filter (where e.type = 'Income'), 0)
+            - coalesce(sum(e.amount) filter (where e.type = 'Expense'), 0)
+    from expenses e
+    where (for_user is null or e.user_id = for_user)
+      and (start_date is null or e.date >= start_date)
+      and (end_date is null or e.date <= end_date)
+    group by 1
+    order by 1;
+$$;
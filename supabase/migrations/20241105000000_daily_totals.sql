@@ -0,0 +1,27 @@
+-- Daily totals per category for the trends view, which resamples them into
+-- weeks and months. One row per day and category instead of every entry.
+
+create or replace function get_daily_totals(
+    start_date date default null,
+    end_date date default null,
+    entry_type text default 'Expense',
+    for_user bigint default null
+)
+returns table (
+    date date,
+    category text,
+    amount numeric
+)
+language sql
+stable
+as $$
+    select e.date, c.name, sum(e.amount)
+    from expenses e
+    join categories c on c.id = e.category
+    where e.type = entry_type
+      and (for_user is null or e.user_id = for_user)
+      and (start_date is null or e.date >= start_date)
+      and (end_date is null or e.date <= end_date)
+    group by 1, 2
+    order by 1, 2;
+$$;
@@ -0,0 +1,13 @@
+-- Categories belong to the account that created them, so imports that
+-- create categories don't show up in other accounts' selects and filters.
+-- Those from before accounts existed have no owner and stay shared.
+
+alter table categories
+    add column if not exists user_id bigint references users (id);
+
+-- Names are unique per account now, shared ones included
+alter table categories drop constraint if exists categories_name_key;
+alter table categories
+    add constraint categories_user_id_name_key unique nulls not distinct (user_id, name);
+
+create index if not exists categories_user_id_idx on categories (user_id);
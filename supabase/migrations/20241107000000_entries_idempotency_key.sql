@@ -0,0 +1,24 @@
+-- Return idempotency_key with the entries, so queued inserts that have
+-- already been flushed can be told apart from those still pending, see
+-- write_queue.apply_pending.
+drop function if exists get_expenses_with_categories();
+create function get_expenses_with_categories()
+returns table (
+    id bigint,
+    type text,
+    title text,
+    category text,
+    amount numeric,
+    date date,
+    updated_at timestamptz,
+    user_id bigint,
+    idempotency_key uuid
+)
+language sql
+stable
+as $$
+    select e.id, e.type, e.title, c.name as category, e.amount, e.date,
+        e.updated_at, e.user_id, e.idempotency_key
+    from expenses e
+    join categories c on c.id = e.category;
+$$;
@@ -0,0 +1,30 @@
+-- Apply edits to several entries in one request. SupabaseClient used to
+-- upsert on id, which inserted an entry again when it had been deleted
+-- since the table was loaded. An update leaves it deleted. Columns an edit
+-- leaves out keep their value, none of them can be null. A null for_user
+-- updates entries of every account.
+create or replace function update_entries(
+    entries jsonb,
+    for_user bigint default null
+)
+returns setof expenses
+language sql
+as $$
+    update expenses e
+    set type = coalesce(r.type, e.type),
+        title = coalesce(r.title, e.title),
+        category = coalesce(r.category, e.category),
+        amount = coalesce(r.amount, e.amount),
+        date = coalesce(r.date, e.date)
+    from jsonb_to_recordset(entries) as r (
+        id bigint,
+        type text,
+        title text,
+        category bigint,
+        amount numeric,
+        date date
+    )
+    where e.id = r.id
+      and (for_user is null or e.user_id = for_user)
+    returning e.*;
+$$;
@@ -0,0 +1,37 @@
+"""CSV imports into a SQLite ledger, re-uploading a file adds nothing."""
+
+import io
+
+import pytest
+
+from sqlite_client import SQLiteClient
+
+COFFEE = b"type,title,category,amount,date\nExpense,Coffee shop,,3.5,2024/01/02\n"
+
+
+@pytest.fixture
+def client(tmp_path):
+    client = SQLiteClient(str(tmp_path / "save_it.sqlite3"))
+    yield client
+    client.close()
+
+
+def test_reimport_without_category_adds_nothing_once_titles_are_learned(client):
+    assert client.process_csv(io.BytesIO(COFFEE))["inserted"] == 1
+    # The categorizer would now file the row under Food, not Uncategorized
+    client.add_categories(["Food"])
+    food = client.category_id("Food")
+    for day in ("2024-01-05", "2024-01-06"):
+        client.save_entry("Expense", "Coffee shop", food, 3.5, day)
+
+    preview = client.preview_csv(io.BytesIO(COFFEE))
+    assert (preview["new"], preview["duplicates"]) == (0, 1)
+    summary = client.process_csv(io.BytesIO(COFFEE))
+    assert (summary["inserted"], summary["duplicates"]) == (0, 1)
+    assert len(client.load_data()) == 3
+
+
+def test_uncategorized_entries_teach_the_categorizer_nothing(client):
+    client.process_csv(io.BytesIO(COFFEE))
+    summary = client.process_csv(io.BytesIO(COFFEE.replace(b"01/02", b"01/03")))
+    assert (summary["inserted"], summary["categorized"]) == (1, 0)
@@ -0,0 +1,236 @@
+"""Apply supabase/migrations to a real Postgres and check the RPCs against a
+hand-computed ledger.
+
+Uses TEST_DATABASE_URL when set, whose public schema is dropped and
+recreated, so point it at a throwaway database. Otherwise starts a
+throwaway server with pgserver, and skips when neither is available."""
+
+import os
+from datetime import date
+from decimal import Decimal
+from pathlib import Path
+
+import pytest
+
+psycopg = pytest.importorskip("psycopg")
+
+MIGRATIONS = sorted(
+    (Path(__file__).parent.parent / "supabase" / "migrations").glob("*.sql")
+)
+
+# The tables created in the Supabase dashboard before there were migrations,
+# and the roles PostgREST runs as
+BASE_SCHEMA = """
+do $$
+begin
+    if not exists (select from pg_roles where rolname = 'anon') then
+        create role anon nologin;
+    end if;
+    if not exists (select from pg_roles where rolname = 'authenticated') then
+        create role authenticated nologin;
+    end if;
+end;
+$$;
+
+create table categories (
+    id bigint generated by default as identity primary key,
+    name text unique not null
+);
+
+create table expenses (
+    id bigint generated by default as identity primary key,
+    type text not null,
+    title text not null,
+    category bigint not null references categories (id),
+    amount numeric not null,
+    date date not null
+);
+
+-- Like Supabase, tables created later are readable by the API roles too
+grant usage on schema public to anon, authenticated;
+grant all on all tables in schema public to anon, authenticated;
+alter default privileges in schema public
+    grant all on tables to anon, authenticated;
+"""
+
+LEDGER = """
+insert into users (username, password_hash) values ('alice', 'x'), ('bob', 'x');
+insert into categories (name) values ('Food'), ('Rent'), ('Salary');
+insert into expenses (type, title, category, amount, date, user_id) values
+    ('Expense', 'Market', 1, 10.50, '2024-01-05', 1),
+    ('Expense', 'Landlord', 2, 500, '2024-01-20', 1),
+    ('Income', 'Payroll', 3, 1000, '2024-01-31', 1),
+    ('Expense', 'Market', 1, 20.25, '2024-02-03', 1),
+    ('Expense', 'Bakery', 1, 4.75, '2024-02-29', 1),
+    ('Income', 'Payroll', 3, 1000, '2024-03-01', 1),
+    ('Expense', 'Market', 1, 99, '2024-01-10', 2);
+"""
+
+
+@pytest.fixture(scope="module")
+def database_url(tmp_path_factory):
+    url = os.environ.get("TEST_DATABASE_URL")
+    if url:
+        yield url
+        return
+    pgserver = pytest.importorskip("pgserver")
+    server = pgserver.get_server(tmp_path_factory.mktemp("pg"), cleanup_mode="stop")
+    yield server.get_uri()
+    server.cleanup()
+
+
+@pytest.fixture(scope="module")
+def db(database_url):
+    """A fresh schema with every migration applied and the ledger loaded"""
+    with psycopg.connect(database_url, autocommit=True) as conn:
+        conn.execute("drop schema if exists public cascade")
+        conn.execute("create schema public")
+        conn.execute(BASE_SCHEMA)
+        for migration in MIGRATIONS:
+            conn.execute(migration.read_text())
+        conn.execute(LEDGER)
+        yield conn
+
+
+def rows(db, sql: str, *params) -> list[tuple]:
+    return db.execute(sql, params).fetchall()
+
+
+def test_monthly_totals(db):
+    assert rows(db, "select * from get_monthly_totals(for_user => 1)") == [
+        (date(2024, 1, 1), "Expense", "Food", Decimal("10.50")),
+        (date(2024, 1, 1), "Expense", "Rent", Decimal("500")),
+        (date(2024, 1, 1), "Income", "Salary", Decimal("1000")),
+        (date(2024, 2, 1), "Expense", "Food", Decimal("25.00")),
+        (date(2024, 3, 1), "Income", "Salary", Decimal("1000")),
+    ]
+
+
+def test_monthly_totals_bounds_and_accounts(db):
+    assert rows(
+        db,
+        "select * from get_monthly_totals('2024-02-01', '2024-02-28', 1)",
+    ) == [(date(2024, 2, 1), "Expense", "Food", Decimal("20.25"))]
+    # Without an account every account's entries are summed
+    assert rows(
+        db,
+        "select amount from get_monthly_totals('2024-01-01', '2024-01-31') "
+        "where category = 'Food'",
+    ) == [(Decimal("109.50"),)]
+
+
+def test_category_totals(db):
+    assert rows(db, "select * from get_category_totals(for_user => 1)") == [
+        ("Rent", Decimal("500")),
+        ("Food", Decimal("35.50")),
+    ]
+    assert rows(
+        db, "select * from get_category_totals(entry_type => 'Income', for_user => 1)"
+    ) == [("Salary", Decimal("2000"))]
+    assert rows(db, "select * from get_category_totals(for_user => 2)") == [
+        ("Food", Decimal("99")),
+    ]
+
+
+def test_savings_series(db):
+    assert rows(db, "select * from get_savings_series(for_user => 1)") == [
+        (date(2024, 1, 1), Decimal("1000"), Decimal("510.50"), Decimal("489.50")),
+        (date(2024, 2, 1), Decimal("0"), Decimal("25.00"), Decimal("-25.00")),
+        (date(2024, 3, 1), Decimal("1000"), Decimal("0"), Decimal("1000")),
+    ]
+
+
+def test_daily_totals(db):
+    assert rows(
+        db, "select * from get_daily_totals(start_date => '2024-02-01', for_user => 1)"
+    ) == [
+        (date(2024, 2, 3), "Food", Decimal("20.25")),
+        (date(2024, 2, 29), "Food", Decimal("4.75")),
+    ]
+
+
+def test_users_are_hidden_from_postgrest_roles(db):
+    with pytest.raises(psycopg.errors.InsufficientPrivilege):
+        with db.transaction():
+            db.execute("set local role anon")
+            db.execute("select password_hash from users")
+
+
+def test_category_names_are_unique_per_account(db):
+    with db.transaction():
+        db.execute("insert into categories (name, user_id) values ('Gym', 1)")
+        db.execute("insert into categories (name, user_id) values ('Gym', 2)")
+        db.execute(
+            "insert into categories (name, user_id) values ('Gym', 1) "
+            "on conflict (user_id, name) do nothing"
+        )
+        assert rows(db, "select count(*) from categories where name = 'Gym'") == [
+            (2,)
+        ]
+        # Shared categories have no account, they are unique among themselves
+        with pytest.raises(psycopg.errors.UniqueViolation):
+            with db.transaction():
+                db.execute("insert into categories (name) values ('Food')")
+        db.execute(
+            "insert into categories (name, user_id) values ('Food', null) "
+            "on conflict (user_id, name) do nothing"
+        )
+        assert rows(db, "select count(*) from categories where name = 'Food'") == [
+            (1,)
+        ]
+        db.execute("delete from categories where name = 'Gym'")
+
+
+def test_deletes_leave_tombstones(db):
+    with db.transaction():
+        (entry,) = rows(db, "delete from expenses where user_id = 2 returning id")
+        assert rows(
+            db, "select id, user_id from expenses_tombstones where id = %s", entry[0]
+        ) == [(entry[0], 2)]
+        # Roll the ledger back for the other tests
+        raise psycopg.Rollback
+
+
+def test_entries_carry_their_idempotency_key(db):
+    with db.transaction():
+        key = "5f0c6f5e-8d2b-4a3c-9b1e-2f4d6a8c0e1f"
+        db.execute(
+            "insert into expenses (type, title, category, amount, date, user_id, "
+            "idempotency_key) select 'Expense', 'Coffee', id, 2.5, '2024-03-01', "
+            "1, %s from categories where name = 'Food' and user_id is null",
+            (key,),
+        )
+        assert rows(
+            db,
+            "select title, idempotency_key::text from get_expenses_with_categories() "
+            "where idempotency_key is not null",
+        ) == [("Coffee", key)]
+        raise psycopg.Rollback
+
+
+def test_update_entries_leaves_deleted_and_other_accounts_entries_alone(db):
+    with db.transaction():
+        [(deleted,)] = rows(
+            db, "delete from expenses where title = 'Bakery' returning id"
+        )
+        [(market,)] = rows(
+            db, "select id from expenses where title = 'Market' and user_id = 2"
+        )
+        [(payroll,)] = rows(db, "select id from expenses where date = '2024-03-01'")
+        edits = [
+            {"id": payroll, "title": "Bonus", "amount": 1200},
+            {"id": deleted, "title": "Cake"},
+            {"id": market, "title": "Stolen"},
+        ]
+        assert rows(
+            db,
+            "select id, title, amount from update_entries(%s, 1)",
+            psycopg.types.json.Jsonb(edits),
+        ) == [(payroll, "Bonus", Decimal("1200"))]
+        assert rows(db, "select count(*) from expenses where id = %s", deleted) == [
+            (0,)
+        ]
+        assert rows(db, "select title from expenses where id = %s", market) == [
+            ("Market",)
+        ]
+        raise psycopg.Rollback
@@ -0,0 +1,89 @@
+"""Run the scheduled reports end to end against a SQLite ledger, delivering
+them to a local SMTP server started with aiosmtpd."""
+
+import socket
+from datetime import date, timedelta
+from email import message_from_bytes
+from functools import partial
+
+import pytest
+
+pytest.importorskip("aiosmtpd")
+from aiosmtpd.controller import Controller  # noqa: E402
+
+import report  # noqa: E402
+import supabase_client  # noqa: E402
+import worker  # noqa: E402
+from sqlite_client import SQLiteClient  # noqa: E402
+
+
+class Inbox:
+    def __init__(self) -> None:
+        self.envelopes = []
+
+    async def handle_DATA(self, server, session, envelope):
+        self.envelopes.append(envelope)
+        return "250 Message accepted for delivery"
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@pytest.fixture
+def inbox(monkeypatch):
+    inbox = Inbox()
+    controller = Controller(inbox, hostname="127.0.0.1", port=free_port())
+    controller.start()
+    monkeypatch.setattr(report, "SMTP_HOST", controller.hostname)
+    monkeypatch.setattr(report, "SMTP_PORT", controller.port)
+    monkeypatch.setattr(report, "SMTP_SSL", False)
+    monkeypatch.setattr(report, "EMAIL_ADDRESS", "reports@example.com")
+    monkeypatch.setattr(report, "EMAIL_PASSWORD", None)
+    yield inbox
+    controller.stop()
+
+
+@pytest.fixture
+def ledger(tmp_path, monkeypatch):
+    """A SQLite ledger with entries from last week for alice"""
+    path = str(tmp_path / "save_it.sqlite3")
+    (user,) = SQLiteClient(path).add_user("alice", "x").data
+    client = SQLiteClient(path, user_id=user["id"])
+    client.add_categories(["Food"])
+    day = date.today() - timedelta(days=3)
+    client.save_entry("Expense", "Market", client.category_id("Food"), 12.5, day)
+    client.close()
+    monkeypatch.setattr(supabase_client, "sqlite_path", path)
+    monkeypatch.setattr(
+        worker, "create_storage", partial(supabase_client.create_storage, "sqlite")
+    )
+    monkeypatch.setattr(worker, "_client", None)
+    monkeypatch.setattr(
+        worker, "REPORT_RECIPIENTS", ["alice@example.com", " bob@example.com"]
+    )
+
+
+def test_weekly_report_is_emailed_to_every_recipient(ledger, inbox, monkeypatch):
+    monkeypatch.setattr(worker, "REPORT_USER", "alice")
+    worker.weekly_report()
+    assert sorted(e.rcpt_tos for e in inbox.envelopes) == [
+        ["alice@example.com"],
+        ["bob@example.com"],
+    ]
+    for envelope in inbox.envelopes:
+        msg = message_from_bytes(envelope.content)
+        assert msg["Subject"].startswith("Weekly Expense Report")
+        (attachment,) = [
+            part for part in msg.walk() if part.get_filename() == "expense_report.pdf"
+        ]
+        assert attachment.get_payload(decode=True).startswith(b"%PDF")
+
+
+def test_unknown_report_user_sends_nothing(ledger, inbox, monkeypatch):
+    monkeypatch.setattr(worker, "REPORT_USER", "carol")
+    worker.weekly_report()
+    assert inbox.envelopes == []
+    assert worker._client is None
@@ -0,0 +1,93 @@
+"""The write-behind queue in front of a SQLite ledger, flushed by hand."""
+
+import threading
+import time
+
+import pytest
+from postgrest.base_request_builder import APIResponse
+from postgrest.exceptions import APIError
+
+from sqlite_client import SQLiteClient
+from write_queue import MAX_ATTEMPTS, WriteBehindQueue
+
+
+@pytest.fixture
+def client(tmp_path):
+    client = SQLiteClient(
+        str(tmp_path / "save_it.sqlite3"),
+        write_queue_path=str(tmp_path / "write_queue.sqlite3"),
+    )
+    # Flushed by the tests, not the background thread
+    client.write_queue.stop()
+    client.add_categories(["Food"])
+    yield client
+    client.close()
+
+
+def entry(title: str, category: int) -> dict:
+    return {
+        "type": "Expense",
+        "title": title,
+        "category": category,
+        "amount": 2.0,
+        "date": "2024-01-02",
+    }
+
+
+def test_rejected_mutation_doesnt_take_its_batch_down(client):
+    food = client.category_id("Food")
+    for payload in (entry("A", food), entry("bad", 999), entry("good", food)):
+        client.write("insert", [payload])
+    for _ in range(MAX_ATTEMPTS):
+        with pytest.raises(APIError):
+            client.write_queue.flush()
+    assert [w["payload"]["title"] for w in client.failed_writes()] == ["bad"]
+    assert client.write_queue.flush() == 1
+    assert sorted(client.load_data()["title"]) == ["A", "good"]
+
+
+def test_queued_inserts_count_in_the_rollup(client):
+    client.write("insert", [entry("A", client.category_id("Food"))])
+    assert client.load_rollup()["amount"].tolist() == [2.0]
+    client.write_queue.flush()
+    assert client.load_rollup()["amount"].tolist() == [2.0]
+
+
+class SlowServer:
+    """Records what it applies, and whether two flushes ever overlapped"""
+
+    def __init__(self) -> None:
+        self.applied = []
+        self.busy = threading.Lock()
+        self.overlapped = False
+
+    def apply_mutations(self, op: str, payloads: list[dict]) -> APIResponse:
+        if not self.busy.acquire(blocking=False):
+            self.overlapped = True
+            self.busy.acquire()
+        try:
+            time.sleep(0.05)
+            self.applied.extend(p["title"] for p in payloads)
+        finally:
+            self.busy.release()
+        return APIResponse(data=payloads, count=None)
+
+
+def test_queues_on_one_file_never_flush_at_once(tmp_path):
+    """Like an evicted account's queue finishing its last flush while the
+    account's new storage starts flushing"""
+    server = SlowServer()
+    path = str(tmp_path / "write_queue.sqlite3")
+    old, new = (WriteBehindQueue(server, path, batch_size=1) for _ in range(2))
+    for title in ("A", "B", "C"):
+        old.enqueue("insert", [{"title": title}])
+    flushes = [
+        threading.Thread(target=lambda q=q: [q.flush() for _ in range(3)])
+        for q in (old, new)
+    ]
+    for flush in flushes:
+        flush.start()
+    for flush in flushes:
+        flush.join()
+    assert not server.overlapped
+    assert server.applied == ["A", "B", "C"]